@@ -23,7 +23,7 @@ def simulate(impulses, outputs, T_sim):
         
     return simulation
 
-@numba.njit(parallel=True)
+@numba.njit(cache=True, parallel=True)
 def simul_shock(dX, epsilons):
     """Take in any impulse response dX to epsilon shock, plus path of epsilons, and simulate"""    
     # if I have T_eps epsilons, can simulate length T_eps - T + 1 dXtildes
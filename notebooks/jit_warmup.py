@@ -0,0 +1,118 @@
+"""
+Compile the jitted code used by the lectures ahead of time.
+
+All numba functions in sim_steady_state(_fast), sim_fake_news, smooth_sim, winding_number
+and estimation.routines are compiled with cache=True. The first process to call a function
+for a given signature saves the machine code to __pycache__ next to the module (or under
+NUMBA_CACHE_DIR, if set), and later processes load it rather than recompiling.
+
+warmup() runs each group of modules once on a small problem, so that this cache holds the
+signatures that the notebooks and estimation workers actually use. Grid sizes do not matter
+for signatures, only dtypes and array layouts do, so small problems suffice.
+
+    python jit_warmup.py                    # warm up all groups
+    python jit_warmup.py sim smooth         # warm up some groups
+    python jit_warmup.py --benchmark        # time cold vs. cached startup in fresh processes
+
+Numba only checks the timestamp of the file containing each function, so after editing a
+module that other jitted code calls into (e.g. smooth_sim/spline.py), clear __pycache__.
+Cached code also records the name its module was imported under, so always import a module
+by the same name (e.g. smooth_sim.utils, never utils from inside smooth_sim/).
+"""
+
+import os
+import sys
+import json
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+
+"""Warm-up for each group of modules"""
+
+def warmup_sim():
+    import sim_engine
+    import sim_fake_news
+    for name in ('reference', 'fast'):
+        sim = sim_engine.backend(name)
+        calib = sim.example_calibration()
+        calib['a_grid'] = sim.discretize_assets(0, 10_000, 50)
+        ss = sim.steady_state(**calib)
+
+    shocks = {'r': {'r': 1.}, 'y': {'y': ss['y']}}
+    for kwargs in (dict(), dict(parallel=True), dict(analytic=True)):
+        sim_fake_news.jacobian(ss, shocks, 5, **kwargs)
+    sim.steady_state_batch(calib['Pi'], calib['a_grid'], calib['y'], calib['r'] + np.zeros(2),
+                           calib['beta'], calib['eis'], parallel=True)
+
+
+def warmup_smooth():
+    from smooth_sim import smooth_sim as sm, utils, fake_news
+    # (the default fixed-point iteration for the distribution needs a reasonably fine grid)
+    a_grid = utils.discretize_assets(0, 10_000, 200)
+    y, _, Pi = utils.discretize_income(0.92, 0.8, 11)
+    for parallel in (False, True):
+        ss = sm.steady_state(Pi, a_grid, y, 0.02, 0.95, 1, 0.3, 0.8, parallel=parallel)
+    fake_news.jacobian(ss, {'r': {'r': 1.}}, 5)
+
+
+def warmup_estimation():
+    from estimation import routines
+    routines.simul_shock(np.ones(5), np.ones(10))
+
+
+def warmup_winding():
+    import winding_number
+    winding_number.winding_number(np.array([0.5, 1., 0.5]), N=16)
+
+
+WARMUPS = {'sim': warmup_sim, 'smooth': warmup_smooth,
+           'estimation': warmup_estimation, 'winding': warmup_winding}
+
+
+def warmup(groups=None):
+    """Compile (or load from cache) the common signatures of 'groups', default all of WARMUPS,
+    returning the time taken by each"""
+    groups = list(WARMUPS) if groups is None else groups
+    times = {}
+    for g in groups:
+        if g not in WARMUPS:
+            raise ValueError(f"Unknown warm-up group '{g}', choose from {list(WARMUPS)}")
+        start = time.perf_counter()
+        WARMUPS[g]()
+        times[g] = time.perf_counter() - start
+    return times
+
+
+"""Startup benchmark"""
+
+def benchmark(groups=None):
+    """Time warmup(groups) in fresh processes, first with an empty numba cache (cold start)
+    and then again with the cache it filled (warm start), returning dict of times by group"""
+    groups = list(WARMUPS) if groups is None else groups
+    code = f"import json, jit_warmup; print(json.dumps(jit_warmup.warmup({groups!r})))"
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+        for label in ('cold', 'warm'):
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], cwd=here, env=env,
+                                 capture_output=True, text=True, check=True).stdout
+            results[label] = dict(json.loads(out.strip().splitlines()[-1]), total=time.perf_counter() - start)
+    return results
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--benchmark' in args:
+        args.remove('--benchmark')
+        results = benchmark(args or None)
+        print(f"{'':12s}{'cold (s)':>10s}{'warm (s)':>10s}")
+        for g in results['cold']:
+            print(f"{g:12s}{results['cold'][g]:10.2f}{results['warm'][g]:10.2f}")
+    else:
+        for g, t in warmup(args or None).items():
+            print(f"{g}: {t:.2f}s")
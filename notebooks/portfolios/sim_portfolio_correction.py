@@ -2,8 +2,13 @@
 # and then adding additional code to compute the Jacobian correction
 
 import numpy as np
-import portfolios.sim_steady_state_fast_p as sim
+import sim_engine
 from numba import njit
+from scipy import sparse
+
+# besides the standard interface, uses the numba kernels of the fast backend directly
+sim = sim_engine.backend('fast', require=('interpolate_lottery_loop', 'interpolate_monotonic_loop',
+                                          'setmin', 'backward_iteration_fused'))
 
 def ss_add_lotteries(ss):
     """Add lotteries and D_next to SS"""
@@ -35,49 +40,68 @@ def backward_iteration(Va, Pi, a_grid, y, r, beta, eis):
     return Va, a, c
 
 
-def jacobian_with_correction(ss, shocks, T, no_con=False):
+def jacobian_with_correction(ss, shocks, T, no_con=False, return_transfers=True, combined=False):
     """Gives Jacobian of A and C at horizon 'T' of standard incomplete markets
     model around steady state 'ss', with respect to each input shock in 'shocks'.
     'shocks' is a dict with entries (i, shock), where i is the arbitrary
     name given to a shock, and 'shock' is itself a dict with entries
-    (k, dx) that specify by how much 'dx' shock perturbs each input 'k'."""
+    (k, dx) that specify by how much 'dx' shock perturbs each input 'k'.
+    If not 'return_transfers', curlyT and curlyWa are not stored, saving memory,
+    and their entries are None. If 'combined', Js is the corrected Jacobian
+    (standard plus correction) and Js_corr is None."""
     # note: now modified to account for effects of portfolios!
-
-    # step 1 for all shocks i, allocate to curlyY[o][i] and curlyD[i]
-    curlyY = {'A': {}, 'C': {}}
-    curlyD, curlyD_corr, curlyT, curlyWa, curlylambda = {}, {}, {}, {}, {}
-    for i, shock in shocks.items():
-        (curlyYi, curlyD[i], curlyD_corr[i],
-            curlyT[i], curlyWa[i], curlylambda[i]) = step1_backward(ss, shock, T, 1E-4, no_con)
-        curlyY['A'][i], curlyY['C'][i] = curlyYi['A'], curlyYi['C']
+    outputs = ('A', 'C')
+    hh = ss.internals['hh']
+    
+    # step 1 for all shocks i, allocate to curlyY[o][i], and write curlyD[i] and curlyD_corr[i] into
+    # one stacked array, so that all of step 3 is a single matrix product
+    curlyY = {o: {} for o in outputs}
+    curlyDs = np.empty((2, len(shocks), T) + hh['D'].shape)
+    curlyT, curlyWa, curlylambda = {}, {}, {}
+    for k, (i, shock) in enumerate(shocks.items()):
+        (curlyYi, _, _, curlyT[i], curlyWa[i], curlylambda[i]) = step1_backward(
+            ss, shock, T, 1E-4, no_con, return_transfers, curlyD=curlyDs[0, k], curlyD_corr=curlyDs[1, k])
+        for o in outputs:
+            curlyY[o][i] = curlyYi[o]
     
-    # step 2 for all outputs o of interest (here A and C)
-    curlyE = {}
-    for o in ('A', 'C'):
-        curlyE[o] = sim.expectation_functions(ss.internals['hh'][o.lower()], ss.internals['hh']['Pi'], ss.internals['hh']['a_i'], ss.internals['hh']['a_pi'], T)
+    # step 2 for all outputs o of interest (here A and C), computed once up to T: the standard part
+    # uses the first T-1 expectation functions, the correction all T
+    curlyE = np.empty((len(outputs), T) + hh['D'].shape)
+    for m, o in enumerate(outputs):
+        curlyE[m] = sim.expectation_functions(hh[o.lower()], hh['Pi'], hh['a_i'], hh['a_pi'], T)
                                             
-    # steps 3 and 4: build fake news matrices, convert to Jacobians
-    Js = {'A': {}, 'C': {}}
-    Js_corr = {'A': {}, 'C': {}}
-    for o in Js:
-        for i in shocks:
+    # step 3: SPEEDUP: fake news for all outputs, shocks, and both parts in one GEMM
+    # news[m, t, p, k, s] = curlyE[m, t] . curlyDs[p, k, s]
+    news = (curlyE.reshape(len(outputs) * T, -1) @ curlyDs.reshape(2 * len(shocks) * T, -1).T
+            ).reshape(len(outputs), T, 2, len(shocks), T)
+
+    # step 4: build fake news matrices, convert to Jacobians
+    Js = {o: {} for o in outputs}
+    Js_corr = None if combined else {o: {} for o in outputs}
+    for m, o in enumerate(outputs):
+        for k, i in enumerate(shocks):
             F = np.empty((T, T))
             F[0, :] = curlyY[o][i]
-            F[1:, :] = curlyE[o][:T-1].reshape(T-1, -1) @ curlyD[i].reshape(T, -1).T
+            F[1:, :] = news[m, :T-1, 0, k]
             Js[o][i] = J_from_F(F)
-            Js_corr[o][i] = curlyE[o].reshape(T, -1) @ curlyD_corr[i].reshape(T, -1).T
+            if combined:
+                Js[o][i] += news[m, :, 1, k]
+            else:
+                Js_corr[o][i] = news[m, :, 1, k].copy()
     
     return Js, Js_corr, curlyT, curlyWa, curlylambda
 
 
-def step1_backward(ss, shock, T, h=1E-4, no_con=False):
+def step1_backward(ss, shock, T, h=1E-4, no_con=False, store_transfers=True, curlyD=None, curlyD_corr=None):
     """Performs step 1 of fake news algorithm, finding curlyY and curlyD up to
     horizon T given 'shock', which is a dict mapping inputs 'k' to how much they
-    are shocked by. Use one-sided numerical diff, scaling down shock by 'h'."""
+    are shocked by. Use one-sided numerical diff, scaling down shock by 'h'.
+    If not 'store_transfers', curlyT and curlyWa are not kept and returned as None.
+    Optionally write curlyD and curlyD_corr into given (T, n_e, n_a) arrays."""
     # NOTE: now obtaining Jacobian correction curlyD_corr as well!
     # see "simple complete market correction.pdf" for details
-
-    ss_inputs = {k: ss.internals['hh'][k] for k in ('Va', 'Pi', 'a_grid', 'y')}
+    hh = ss.internals['hh']
+    ss_inputs = {k: hh[k] for k in ('Va', 'Pi', 'a_grid', 'y')}
     ss_inputs_agg = {k: ss[k] for k in ('r','beta', 'eis')}
     ss_inputs = {**ss_inputs, **ss_inputs_agg}
 
@@ -89,46 +113,117 @@ def step1_backward(ss, shock, T, h=1E-4, no_con=False):
 
     # allocate space for results
     curlyY = {'A': np.empty(T), 'C': np.empty(T)}
-    curlyD = np.empty((T,) + ss.internals['hh']['D'].shape)
-    curlyD_corr = np.empty_like(curlyD)
-    curlyWa = np.empty_like(curlyD)
-    curlyT = np.empty_like(curlyD)
+    if curlyD is None:
+        curlyD = np.empty((T,) + hh['D'].shape)
+    if curlyD_corr is None:
+        curlyD_corr = np.empty_like(curlyD)
+    curlyWa = np.empty_like(curlyD) if store_transfers else None
+    curlyT = np.empty_like(curlyD) if store_transfers else None
     curlylambda = np.empty(T)
-    
-    # backward iterate
-    for s in range(T):
-        if s == 0:
-            # at horizon of s=0, 'shock' actually hits, override ss_inputs with shock
-            shocked_inputs = {k: ss_inputs[k] + h*shock[k] for k in shock}
-            Va, a, c = backward_iteration(**{**ss_inputs, **shocked_inputs})
-        else:
-            # now the only effect is anticipation, so it's just Va being different
-            Va, a, c = backward_iteration(**{**ss_inputs, 'Va': Va})
-        
-        # aggregate effects on A and C
-        curlyY['A'][s] = np.vdot(ss.internals['hh']['D'], a - ss.internals['hh']['a']) / h
-        curlyY['C'][s] = np.vdot(ss.internals['hh']['D'], c - ss.internals['hh']['c']) / h
-        
-        # what is effect on one-period-ahead distribution?
-        da_pi = (a - ss.internals['hh']['a']) / apol_diff / h
-        curlyD[s] = ss.internals['hh']['Pi'].T @ forward_policy_shock(ss.internals['hh']['D'], ss.internals['hh']['a_i'], da_pi)
-
-        # NEW: solving for transfers and effect on distribution
-        dWa = ss.internals['hh']['Pi'] @ ((c - ss.internals['hh']['c']) / h * upp)
-        curlyWa[s] = dWa
-        dT_pe = -dWa / (R*Waa)
-        if no_con:
-            dT_pe[:, 0] = 0  # if you're at constraint, can't get insurance
-        dlambda = np.vdot(Dbeg, dT_pe) / Lambda
-        dT = dT_pe + dlambda * sensitivity
-        dT = R * dT # scaling by R so that we can transfer to post-return wealth
-        curlyD_corr[s] = ss.internals['hh']['Pi'].T @ local_shock(Dbeg, dT / agrid_diff_aug) 
-        curlyT[s] = R*dT # NOTE: Scaling by R here so that we have transfers to post-return wealth
-        curlylambda[s] = dlambda
-        
+
+    # SPEEDUP: pass all steady-state quantities to jitted code as flat arrays, once, along with
+    # scratch space that is reused at every horizon, and the local transfer operators (see local_transfer)
+    # for the policy shock and for the transfers as CSR arrays
+    Pi, PiT = hh['Pi'], np.ascontiguousarray(hh['Pi'].T)
+    work = np.empty((2,) + hh['D'].shape)
+    L_policy, L_local = local_transfer(hh['a_i']), local_transfer(local_index(hh['D'].shape))
+    prelim = (hh['D'], hh['a'], hh['c'], apol_diff, Pi, PiT, upp, R*Waa, R, sensitivity, Dbeg, Lambda,
+              agrid_diff_aug, no_con, h, (L_policy.indptr, L_policy.indices, L_policy.data),
+              (L_local.indptr, L_local.indices, L_local.data), work)
+    outputs = (curlyY['A'], curlyY['C'], curlyD, curlyD_corr, curlyWa, curlyT, curlylambda)
+
+    # at horizon of s=0, 'shock' actually hits, override ss_inputs with shock
+    shocked_inputs = {k: ss_inputs[k] + h*shock[k] for k in shock}
+    Va, a, c = backward_iteration(**{**ss_inputs, **shocked_inputs})
+    step1_effects(0, a, c, *prelim, *outputs)
+
+    # now the only effect is anticipation, so it's just Va being different: backward iterate in jitted loop
+    step1_anticipation(Va, ss['beta'] * Pi, hh['a_grid'], hh['y'], ss['r'], ss['eis'], prelim, outputs)
+
     return curlyY, curlyD, curlyD_corr, curlyT, curlyWa, curlylambda
 
 
+@njit(cache=True)
+def step1_anticipation(Va, beta_Pi, a_grid, y, r, eis, prelim, outputs):
+    """Horizons s = 1, ..., T-1 of step1_backward, backward iterating from Va at s = 0,
+    writing into preallocated outputs and reusing the same buffers at every horizon"""
+    T = len(outputs[0])
+    Va, Va_new = Va.copy(), np.empty_like(Va)
+    a, c = np.empty_like(Va), np.empty_like(Va)
+    for s in range(1, T):
+        sim.backward_iteration_fused(Va, beta_Pi, a_grid, y, r, eis, Va_new, a, c)
+        step1_effects(s, a, c, *prelim, *outputs)
+        Va, Va_new = Va_new, Va
+
+
+@njit(cache=True)
+def step1_effects(s, a, c, D, a_ss, c_ss, apol_diff, Pi, PiT, upp, RWaa, R, sensitivity, Dbeg, Lambda,
+                  agrid_diff_aug, no_con, h, L_policy, L_local, work, curlyY_A, curlyY_C, curlyD, curlyD_corr,
+                  curlyWa, curlyT, curlylambda):
+    """Given policies a and c at horizon s, write entry s of curlyY, curlyD, curlyD_corr, curlylambda,
+    and (unless None) curlyWa and curlyT, using work[0] and work[1] as scratch space"""
+    n_e, n_a = D.shape
+    moved, dD = work[0], work[1]
+
+    # aggregate effects on A and C
+    dA, dC = 0., 0.
+    for e in range(n_e):
+        for i in range(n_a):
+            dA += D[e, i] * (a[e, i] - a_ss[e, i])
+            dC += D[e, i] * (c[e, i] - c_ss[e, i])
+            moved[e, i] = (a[e, i] - a_ss[e, i]) / apol_diff[e, i] / h * D[e, i]
+    curlyY_A[s], curlyY_C[s] = dA / h, dC / h
+
+    # what is effect on one-period-ahead distribution? mass 'moved' up from a_i to a_i+1 by policy shock
+    csr_matvec(*L_policy, moved.ravel(), dD.ravel())
+    np.dot(PiT, dD, curlyD[s])
+
+    # NEW: solving for transfers and effect on distribution
+    dc_upp = work[0]
+    for e in range(n_e):
+        for i in range(n_a):
+            dc_upp[e, i] = (c[e, i] - c_ss[e, i]) / h * upp[e, i]
+    dT_pe = work[1]
+    if curlyWa is not None:
+        np.dot(Pi, dc_upp, curlyWa[s])
+        dWa = curlyWa[s]
+    else:
+        np.dot(Pi, dc_upp, dT_pe)
+        dWa = dT_pe
+
+    dlambda = 0.
+    for e in range(n_e):
+        for i in range(n_a):
+            dT_pe[e, i] = -dWa[e, i] / RWaa[e, i]
+        if no_con:
+            dT_pe[e, 0] = 0  # if you're at constraint, can't get insurance
+        for i in range(n_a):
+            dlambda += Dbeg[e, i] * dT_pe[e, i]
+    dlambda /= Lambda
+
+    # scaling dT by R so that we can transfer to post-return wealth, then mass 'moved' up by transfers
+    moved = work[0]
+    for e in range(n_e):
+        for i in range(n_a):
+            dT = R * (dT_pe[e, i] + dlambda * sensitivity[e, i])
+            if curlyT is not None:
+                curlyT[s, e, i] = R*dT # NOTE: Scaling by R here so that we have transfers to post-return wealth
+            moved[e, i] = dT / agrid_diff_aug[i] * Dbeg[e, i]
+    csr_matvec(*L_local, moved.ravel(), dD.ravel())
+    np.dot(PiT, dD, curlyD_corr[s])
+    curlylambda[s] = dlambda
+
+
+@njit(cache=True)
+def csr_matvec(indptr, indices, data, x, y):
+    """y = A @ x for sparse matrix A in CSR format, writing into y"""
+    for r in range(len(indptr) - 1):
+        acc = 0.
+        for k in range(indptr[r], indptr[r+1]):
+            acc += data[k] * x[indices[k]]
+        y[r] = acc
+
+
 def prelim_ss(ss):
     """Preliminary steady state calculations needed for correction in step 1"""
     agrid_diff = np.diff(ss.internals['hh']['a_grid'])
@@ -155,29 +250,36 @@ def J_from_F(F):
 
 """New helper functions"""
 
-@njit
-def forward_policy_shock(Dss, a_i, da_pi):
-    dD = np.zeros_like(Dss)
-    for e in range(a_i.shape[0]):
-        for a in range(a_i.shape[1]):
-            chg = da_pi[e,a]*Dss[e,a]
-            dD[e, a_i[e,a]] -= chg
-            dD[e, a_i[e,a]+1] += chg
-    return dD
-
-@njit
-def local_shock(Dss, da_pi):
-    dD = np.zeros_like(Dss)
-    for e in range(Dss.shape[0]):
-        for a in range(Dss.shape[1]):
-            chg = da_pi[e,a]*Dss[e,a]
-            if a < Dss.shape[1]:
-                dD[e, a] -= chg
-                dD[e, a+1] += chg
-            else:
-                dD[e, a-1] -= chg
-                dD[e, a] += chg
-    return dD
+def local_transfer(a_i):
+    """Sparse operator sending an amount x[e, a] of mass from gridpoint (e, a_i[e, a]) to gridpoint
+    (e, a_i[e, a]+1), for all (e, a) at once, as a mat-vec on flattened x"""
+    # -x at flattened (e, a_i) and +x at (e, a_i+1), for each source (e, a)
+    n_e, n_a = a_i.shape
+    src = np.arange(n_e*n_a)
+    dest = (n_a*np.arange(n_e)[:, np.newaxis] + a_i).ravel()
+    return sparse.csr_matrix((np.concatenate((-np.ones(n_e*n_a), np.ones(n_e*n_a))),
+                              (np.concatenate((dest, dest + 1)), np.concatenate((src, src)))),
+                             shape=(n_e*n_a, n_e*n_a))
+
+
+def local_index(shape):
+    """a_i for local_transfer that moves mass at each gridpoint a up to a+1, except at the top
+    gridpoint, where the transfer is instead between the two highest gridpoints"""
+    n_e, n_a = shape
+    return np.broadcast_to(np.minimum(np.arange(n_a), n_a - 2), (n_e, n_a))
+
+
+def apply_local_transfer(L, X, Pi=None, out=None):
+    """Apply local_transfer L to X of shape (n_e, n_a), or to a batch (..., n_e, n_a) all at once,
+    optionally followed by the transition Pi.T from e to e', giving next period's distribution.
+    Build L once, e.g. local_transfer(a_i) for a change da_pi in policy lotteries (with X = da_pi*D),
+    or local_transfer(local_index(D.shape)) to move mass up to the next gridpoint, and reuse it."""
+    # row-oriented product X @ L.T, so that the batch stays contiguous
+    Y = (X.reshape(-1, L.shape[1]) @ L.T).reshape(X.shape)
+    if Pi is None:
+        return Y
+    return np.matmul(Pi.T, Y, out=out)
+
 
 def get_mpcs(ss):
     c, a_grid, a, r = ss.internals['hh']['c'], ss.internals['hh']['a_grid'], ss.internals['hh']['a'], ss['r']
@@ -0,0 +1,36 @@
+import numpy as np
+
+import portfolios.sim_portfolio_correction as sim_corr
+
+
+def test_local_transfer_top_gridpoint():
+    # moving mass up to the next gridpoint: at the top gridpoint, mass moves between the two highest
+    rng = np.random.default_rng(0)
+    n_e, n_a = 3, 6
+    L = sim_corr.local_transfer(sim_corr.local_index((n_e, n_a)))
+
+    # all mass in the last column: only the two highest gridpoints change
+    X = np.zeros((n_e, n_a))
+    X[:, -1] = rng.uniform(size=n_e)
+    Y = sim_corr.apply_local_transfer(L, X)
+    assert np.array_equal(Y[:, -2], -X[:, -1]) and np.array_equal(Y[:, -1], X[:, -1])
+    assert np.all(Y[:, :-2] == 0)
+
+    # elsewhere, mass at a moves to a+1, and total mass is conserved, also after transition Pi
+    X = rng.uniform(size=(n_e, n_a))
+    Y = sim_corr.apply_local_transfer(L, X)
+    expected = np.zeros_like(X)
+    expected[:, :-1] -= X[:, :-1]
+    expected[:, 1:] += X[:, :-1]
+    expected[:, -2] -= X[:, -1]
+    expected[:, -1] += X[:, -1]
+    assert np.allclose(Y, expected)
+    assert np.allclose(Y.sum(axis=1), 0)
+
+    Pi = rng.uniform(size=(n_e, n_e))
+    Pi /= Pi.sum(axis=1, keepdims=True)
+    assert np.isclose(sim_corr.apply_local_transfer(L, X, Pi).sum(), 0)
+
+    # batches give the same as one array at a time
+    Xs = rng.uniform(size=(4, n_e, n_a))
+    assert np.allclose(sim_corr.apply_local_transfer(L, Xs), [sim_corr.apply_local_transfer(L, X) for X in Xs])
@@ -0,0 +1,57 @@
+"""
+One place to get the standard incomplete markets (SIM) household code from.
+
+Lecture and extension code (e.g. portfolios/) used to keep their own copies of
+sim_steady_state.py and sim_steady_state_fast.py, which drifted apart and
+compiled every numba function twice. Instead, they now ask for a backend:
+
+    import sim_engine
+    sim = sim_engine.backend('fast')
+
+Every backend is an ordinary module providing at least the functions in
+INTERFACE, which is checked when it is loaded. Code that needs more than that
+(e.g. portfolios/, which calls the numba kernels of the fast backend directly)
+lists the extra functions in 'require', so that choosing a backend without them
+fails right away with a clear error. Each backend is imported only once, so jitted
+functions (and their compiled signatures) are shared by everyone who uses it.
+"""
+
+import importlib
+
+BACKENDS = {
+    'reference': 'sim_steady_state',       # plain NumPy, as built up in the lectures
+    'fast': 'sim_steady_state_fast',       # numba kernels, fused backward iteration, accelerators
+}
+
+DEFAULT = 'fast'
+
+# functions every backend must provide, with the signatures of sim_steady_state.py
+INTERFACE = ('example_calibration', 'discretize_assets', 'discretize_income', 'stationary_markov',
+             'backward_iteration', 'policy_ss', 'forward_policy', 'forward_iteration', 'distribution_ss',
+             'distribution_ss_direct', 'steady_state', 'expectation_functions')
+
+
+def register(name, module):
+    """Make 'module' (an import path) available as backend 'name', e.g. for a
+    parallel or sparse implementation, after checking that it provides INTERFACE"""
+    check(importlib.import_module(module), INTERFACE)
+    BACKENDS[name] = module
+
+
+def backend(name=None, require=()):
+    """Return the module implementing backend 'name' (DEFAULT if None), checking that
+    it provides INTERFACE plus any further functions in 'require'"""
+    name = DEFAULT if name is None else name
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', choose one of {sorted(BACKENDS)}")
+    # import_module goes through sys.modules, so each backend is only loaded once
+    module = importlib.import_module(BACKENDS[name])
+    check(module, INTERFACE + tuple(require))
+    return module
+
+
+def check(module, functions):
+    """Raise ValueError if 'module' lacks any of 'functions'"""
+    missing = [f for f in functions if not hasattr(module, f)]
+    if missing:
+        raise ValueError(f"Backend module '{module.__name__}' is missing {missing}")
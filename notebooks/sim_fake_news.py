@@ -5,57 +5,130 @@ for special case of intertemporal MPCs.
 
 Here, computes sequence-space Jacobian for any list of shocked
 inputs to the household problem (any given input shock can be some
-combination of shock to 'y', 'r', 'beta', and 'eis'), always returns
-Jacobians for outputs 'A' and 'C'.
+combination of shock to 'y', 'r', 'beta', and 'eis'), returns Jacobians
+for outputs 'A' and 'C' by default, or for any other aggregate of some
+function of the policies 'a' and 'c' (see OUTPUTS below).
 """
 
+import functools
 import numpy as np
+import numba
 import sim_steady_state_fast as sim
 
 
-def jacobian(ss, shocks, T):
-    """Gives Jacobian of A and C at horizon 'T' of standard incomplete markets
+"""Outputs: aggregates of any function f(a, c) of the asset and consumption policies"""
+
+def assets(a, c):
+    return a
+
+
+def consumption(a, c):
+    return c
+
+
+# register more outputs here, or pass them directly to jacobian as a dict of name: f
+# (step1_backward_batch aggregates 'assets' and 'consumption' inside its jitted loop)
+OUTPUTS = {'A': assets,
+           'C': consumption}
+
+
+def get_outputs(outputs):
+    """Map 'outputs', either names registered in OUTPUTS or a dict of name: f, to dict of name: f"""
+    if not isinstance(outputs, dict):
+        outputs = {o: OUTPUTS[o] for o in outputs}
+    return {o: float_output(f) for o, f in outputs.items()}
+
+
+def float_output(f):
+    """Wrap f(a, c) so that boolean or integer outputs, e.g. the constrained share
+    lambda a, c: a <= a_grid[0], come back as floats that can be differenced
+    (float and complex outputs, the latter needed by output_derivative, pass through)"""
+    @functools.wraps(f)
+    def f_float(a, c):
+        x = np.asarray(f(a, c))
+        return x if np.issubdtype(x.dtype, np.inexact) else x.astype(np.float64)
+    return f_float
+
+
+"""Fake news algorithm"""
+
+def jacobian(ss, shocks, T, outputs=('A', 'C'), parallel=False, analytic=False, chunk=None, dtype=np.float64):
+    """Gives Jacobian of 'outputs' at horizon 'T' of standard incomplete markets
     model around steady state 'ss', with respect to each input shock in 'shocks'.
     'shocks' is a dict with entries (i, shock), where i is the arbitrary
     name given to a shock, and 'shock' is itself a dict with entries
-    (k, dx) that specify by how much 'dx' shock perturbs each input 'k'."""
-
-    # step 1 for all shocks i, allocate to curlyY[o][i] and curlyD[i]
-    curlyY = {'A': {}, 'C': {}}
-    curlyD = {}
-    for i, shock in shocks.items():
-        curlyYi, curlyD[i] = step1_backward(ss, shock, T, 1E-4)
-        curlyY['A'][i], curlyY['C'][i] = curlyYi['A'], curlyYi['C']
+    (k, dx) that specify by how much 'dx' shock perturbs each input 'k'.
+    'outputs' are names registered in OUTPUTS, or a dict of (o, f) where the
+    aggregate output o is the integral of f(a, c) against the distribution.
+    Step 1 is shared by all outputs, so each output only adds steps 2-4.
+    If 'parallel', does step 1 for all shocks at once, in parallel threads.
+    If 'analytic', does step 1 for all shocks at once with exact derivatives
+    rather than numerical differentiation.
+
+    To save memory at long horizons, 'chunk' gives the number of horizons of expectation
+    functions held in memory at a time (default all T-1), and 'dtype' can be np.float32 to
+    store curlyD and expectation functions in single precision. On the lecture calibration
+    at T=300, float32 storage changes Jacobian entries by at most about 1E-6 relative to
+    the largest entry, well below the error from numerical differentiation in step 1."""
+
+    outputs = get_outputs(outputs)
+
+    # step 1 for all shocks, stacked along first axis: curlyY[o] is (n_shocks, T), curlyD is (n_shocks, T, n_e, n_a)
+    if analytic:
+        curlyY, curlyD = step1_backward_analytic(ss, list(shocks.values()), T, dtype, outputs)
+    elif parallel:
+        curlyY, curlyD = step1_backward_batch(ss, list(shocks.values()), T, 1E-4, outputs=outputs, dtype=dtype)
+    else:
+        curlyY = {o: np.empty((len(shocks), T)) for o in outputs}
+        curlyD = np.empty((len(shocks), T) + ss['D'].shape, dtype=dtype)
+        for k, shock in enumerate(shocks.values()):
+            curlyYk, curlyD[k] = step1_backward(ss, shock, T, 1E-4, outputs)
+            for o in outputs:
+                curlyY[o][k] = curlyYk[o]
     
-    # step 2 for all outputs o of interest (here A and C)
-    curlyE = {}
-    for o in ('A', 'C'):
-        curlyE[o] = sim.expectation_functions(ss[o.lower()], ss['Pi'], ss['a_i'], ss['a_pi'], T-1)
-                                            
-    # steps 3 and 4: build fake news matrices, convert to Jacobians
-    Js = {'A': {}, 'C': {}}
-    for o in Js:
-        for i in shocks:
-            F = np.empty((T, T))
-            F[0, :] = curlyY[o][i]
-            F[1:, :] = curlyE[o].reshape(T-1, -1) @ curlyD[i].reshape(T, -1).T
+    # steps 2 and 3: expectation functions for all outputs o of interest, in chunks
+    # of horizons, each multiplied by curlyD to get a chunk of rows of the fake news matrices
+    # SPEEDUP: stack the chunks for all outputs, and use stacked curlyD for all shocks, so that there
+    # is a single GEMM per chunk (and a single GEMM overall if there is just one chunk)
+    chunk = chunk or T-1
+    curlyD_all = curlyD.reshape(len(shocks)*T, -1).astype(dtype, copy=False)
+    curlyE_chunks = [sim.expectation_functions_chunked(f(ss['a'], ss['c']), ss['Pi'], ss['a_i'], ss['a_pi'], T-1, chunk, dtype)
+                     for f in outputs.values()]
+    F_all = np.empty((len(outputs), T-1, len(shocks), T))
+    for start, curlyE in zip(range(0, T-1, chunk), zip(*curlyE_chunks)):
+        n = len(curlyE[0])
+        F_all[:, start:start+n] = (np.stack(curlyE).reshape(len(outputs)*n, -1) @ curlyD_all.T
+                                   ).reshape(len(outputs), n, len(shocks), T)
+
+    # step 4: convert to Jacobians
+    Js = {o: {} for o in outputs}
+    F = np.empty((T, T))
+    for io, o in enumerate(outputs):
+        for k, i in enumerate(shocks):
+            F[0, :] = curlyY[o][k]
+            F[1:, :] = F_all[io, :, k, :]
             Js[o][i] = J_from_F(F)
     
     return Js
 
 
-def step1_backward(ss, shock, T, h=1E-4):
+def step1_backward(ss, shock, T, h=1E-4, outputs=('A', 'C')):
     """Performs step 1 of fake news algorithm, finding curlyY and curlyD up to
     horizon T given 'shock', which is a dict mapping inputs 'k' to how much they
     are shocked by. Use one-sided numerical diff, scaling down shock by 'h'."""
+    outputs = get_outputs(outputs)
+    Y_ss = {o: f(ss['a'], ss['c']) for o, f in outputs.items()}
 
     # preliminaries: obtain D_1 with no shock, ss inputs to backward_iteration
     D1_noshock = sim.forward_iteration(ss['D'], ss['Pi'], ss['a_i'], ss['a_pi'])
     ss_inputs = {k: ss[k] for k in ('Va', 'Pi', 'a_grid', 'y', 'r', 'beta', 'eis')}
+    beta_Pi = ss['beta'] * ss['Pi']
     
-    # allocate space for results
-    curlyY = {'A': np.empty(T), 'C': np.empty(T)}
+    # allocate space for results, plus extra buffer for Va so that backward iteration
+    # can alternate between two (a and c from s=0 are reused as buffers too)
+    curlyY = {o: np.empty(T) for o in outputs}
     curlyD = np.empty((T,) + ss['D'].shape)
+    Va_next = np.empty_like(ss['Va'])
     
     # backward iterate
     for s in range(T):
@@ -65,11 +138,13 @@ def step1_backward(ss, shock, T, h=1E-4):
             Va, a, c = sim.backward_iteration(**{**ss_inputs, **shocked_inputs})
         else:
             # now the only effect is anticipation, so it's just Va being different
-            Va, a, c = sim.backward_iteration(**{**ss_inputs, 'Va': Va})
+            # (alternate between Va and Va_next buffers, so that nothing is allocated)
+            sim.backward_iteration_fused(Va, beta_Pi, ss['a_grid'], ss['y'], ss['r'], ss['eis'], Va_next, a, c)
+            Va, Va_next = Va_next, Va
         
-        # aggregate effects on A and C
-        curlyY['A'][s] = np.vdot(ss['D'], a - ss['a']) / h
-        curlyY['C'][s] = np.vdot(ss['D'], c - ss['c']) / h
+        # aggregate effects on outputs (A and C by default)
+        for o, f in outputs.items():
+            curlyY[o][s] = np.vdot(ss['D'], f(a, c) - Y_ss[o]) / h
         
         # what is effect on one-period-ahead distribution?
         a_i_shocked, a_pi_shocked = sim.interpolate_lottery_loop(a, ss['a_grid'])
@@ -78,9 +153,240 @@ def step1_backward(ss, shock, T, h=1E-4):
     return curlyY, curlyD
 
 
+def step1_backward_batch(ss, shocks, T, h=1E-4, parallel=True, outputs=('A', 'C'), dtype=np.float64):
+    """Performs step 1 of fake news algorithm like step1_backward, but for a list of
+    'shocks' at once, returning curlyY[o] of shape (K, T) and curlyD of shape
+    (K, T, n_e, n_a), stored as 'dtype'. Only the shocked s=0 iteration is done separately
+    for each shock: the rest is one jitted loop over shocks, in parallel if 'parallel'.
+    The jitted loop aggregates assets and consumption itself, and only if there are other
+    outputs does it record the paths of policies a and c, to evaluate them after."""
+    outputs = get_outputs(outputs)
+    in_loop = {o: i for o, f in outputs.items() for i, g in enumerate((assets, consumption)) if f.__wrapped__ is g}
+
+    # preliminaries as in step1_backward
+    D1_noshock = sim.forward_iteration(ss['D'], ss['Pi'], ss['a_i'], ss['a_pi'])
+    ss_inputs = {k: ss[k] for k in ('Va', 'Pi', 'a_grid', 'y', 'r', 'beta', 'eis')}
+    beta_Pi = ss['beta'] * ss['Pi']
+
+    # at horizon s=0, each shock hits, giving Va, a, c stacked along first axis
+    K = len(shocks)
+    Va, a, c = (np.empty((K,) + ss['Va'].shape) for _ in range(3))
+    for k, shock in enumerate(shocks):
+        shocked_inputs = {i: ss[i] + h*shock[i] for i in shock}
+        Va[k], a[k], c[k] = sim.backward_iteration(**{**ss_inputs, **shocked_inputs})
+
+    # all later horizons, for all shocks at once
+    curlyAC = np.zeros((K, 2, T))
+    curlyD = np.empty((K, T) + ss['D'].shape, dtype=dtype)
+    if len(in_loop) < len(outputs):
+        a_path, c_path = np.empty((K, T) + ss['D'].shape), np.empty((K, T) + ss['D'].shape)
+    else:
+        a_path, c_path = None, None
+    step1 = step1_batch_parallel if parallel else step1_batch_serial
+    step1(Va, a, c, beta_Pi, ss['Pi'], ss['a_grid'], ss['y'], ss['r'], ss['eis'], ss['D'], D1_noshock,
+          h, ss['a'], ss['c'], curlyAC, curlyD, a_path, c_path)
+
+    # aggregate effects on outputs at all horizons
+    curlyY = {}
+    for o, f in outputs.items():
+        if o in in_loop:
+            curlyY[o] = curlyAC[:, in_loop[o]]
+        else:
+            curlyY[o] = (f(a_path, c_path) - f(ss['a'], ss['c'])).reshape(K, T, -1) @ ss['D'].ravel() / h
+    return curlyY, curlyD
+
+
+@numba.njit(cache=True)
+def step1_batch_serial(Va, a, c, beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock, h, a_ss, c_ss,
+                       curlyAC, curlyD, a_path, c_path):
+    for k in range(Va.shape[0]):
+        if a_path is None:
+            step1_one(Va[k], a[k], c[k], beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock,
+                      h, a_ss, c_ss, curlyAC[k], curlyD[k], None, None)
+        else:
+            step1_one(Va[k], a[k], c[k], beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock,
+                      h, a_ss, c_ss, curlyAC[k], curlyD[k], a_path[k], c_path[k])
+
+
+@numba.njit(cache=True, parallel=True)
+def step1_batch_parallel(Va, a, c, beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock, h, a_ss, c_ss,
+                         curlyAC, curlyD, a_path, c_path):
+    for k in numba.prange(Va.shape[0]):
+        if a_path is None:
+            step1_one(Va[k], a[k], c[k], beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock,
+                      h, a_ss, c_ss, curlyAC[k], curlyD[k], None, None)
+        else:
+            step1_one(Va[k], a[k], c[k], beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock,
+                      h, a_ss, c_ss, curlyAC[k], curlyD[k], a_path[k], c_path[k])
+
+
+@numba.njit(cache=True)
+def step1_one(Va, a, c, beta_Pi, Pi, a_grid, y, r, eis, D, D1_noshock, h, a_ss, c_ss,
+              curlyAC, curlyD, a_path, c_path):
+    """Jitted equivalent of the loop in step1_backward for one shock, starting from Va, a, c
+    at s=0 (which are overwritten), writing effects on A and C into curlyAC (zeroed) and
+    on the distribution into curlyD, and if a_path is not None, the policies into a_path, c_path"""
+    Va_next = np.empty_like(Va)
+    for s in range(len(curlyD)):
+        if s > 0:
+            sim.backward_iteration_fused(Va, beta_Pi, a_grid, y, r, eis, Va_next, a, c)
+            Va, Va_next = Va_next, Va
+
+        for e in range(D.shape[0]):
+            for j in range(D.shape[1]):
+                curlyAC[0, s] += D[e, j] * (a[e, j] - a_ss[e, j])
+                curlyAC[1, s] += D[e, j] * (c[e, j] - c_ss[e, j])
+        curlyAC[0, s] /= h
+        curlyAC[1, s] /= h
+        if a_path is not None:
+            a_path[s], c_path[s] = a, c
+
+        a_i_shocked, a_pi_shocked = sim.interpolate_lottery_loop(a, a_grid)
+        curlyD[s] = (Pi.T @ sim.forward_policy(D, a_i_shocked, a_pi_shocked) - D1_noshock) / h
+
+
+ANALYTIC_INPUTS = ('y', 'r', 'beta', 'eis')
+
+
+def step1_backward_analytic(ss, shocks, T, dtype=np.float64, outputs=('A', 'C')):
+    """Performs step 1 of fake news algorithm for a list of 'shocks' at once, returning
+    curlyY and curlyD stacked like step1_backward_batch. Rather than differencing shocked
+    backward iterations, propagates exact derivatives dVa, da, dc through the backward
+    iteration linearized around the steady state, with all shocks stacked along first axis.
+    Optionally stores curlyD in lower precision 'dtype'."""
+    # the linearization only covers these inputs, so e.g. a shock to 'Pi' cannot be done exactly
+    for shock in shocks:
+        unsupported = set(shock) - set(ANALYTIC_INPUTS)
+        if unsupported:
+            raise ValueError(f"Analytic step 1 only supports shocks to {ANALYTIC_INPUTS}, not {sorted(unsupported)}; "
+                             f"use analytic=False for these")
+
+    outputs = get_outputs(outputs)
+    lin = linearize_backward(ss)
+    K, n_e = len(shocks), len(ss['y'])
+    curlyY = {o: np.empty((K, T)) for o in outputs}
+    curlyD = np.empty((K, T) + ss['D'].shape, dtype=dtype)
+
+    # derivatives of all inputs, stacked and shaped (K, n_e, 1) to broadcast against (K, n_e, n_a)
+    dinputs = {k: np.stack([np.broadcast_to(np.reshape(shock.get(k, 0.), (-1, 1)), (n_e, 1)) for shock in shocks])
+               for k in ANALYTIC_INPUTS}
+    
+    dVa_next, da = np.empty((K,) + ss['Va'].shape), np.empty((K,) + ss['Va'].shape)
+    for s in range(T):
+        if s == 0:
+            # at horizon of s=0, 'shock' actually hits
+            dVa, da, dc = backward_iteration_linear(np.zeros_like(da), lin, **dinputs)
+        else:
+            # now the only effect is anticipation, through dVa, so use jitted kernel
+            # (alternate between dVa and dVa_next buffers, so that nothing is allocated)
+            backward_anticipation_linear(dVa, lin['beta_Pi'], lin['coh_endog_coef'], lin['j'], lin['pi'],
+                                         lin['slope'], lin['Va_coef'], dVa_next, da)
+            dVa, dVa_next = dVa_next, dVa
+            dc = -da
+
+        # aggregate effects on outputs (A and C by default)
+        for o, f in outputs.items():
+            curlyY[o][:, s] = output_derivative(f, ss['a'], ss['c'], da, dc).reshape(K, -1) @ ss['D'].ravel()
+
+        # effect on one-period-ahead distribution: da changes probability a_pi on lower gridpoint
+        curlyD[:, s] = ss['Pi'].T @ forward_policy_shock(ss['D'], ss['a_i'], -da / lin['a_grid_gap'])
+
+    return curlyY, curlyD
+
+
+def output_derivative(f, a, c, da, dc, h=1E-20):
+    """Derivative of f(a, c) in direction (da, dc) by complex step, exact to machine precision
+    as long as f is built from numpy functions that extend to complex inputs analytically
+    (no abs; comparisons and np.maximum and np.minimum are fine, and have zero derivative)"""
+    return f(a + 1j*h*da, c + 1j*h*dc).imag / h
+
+
+def linearize_backward(ss):
+    """Steady-state objects needed by backward_iteration_linear, from rerunning the
+    steps of backward_iteration at ss['Va'] and recording interpolation brackets"""
+    Pi, a_grid, y, r, beta, eis = (ss[k] for k in ('Pi', 'a_grid', 'y', 'r', 'beta', 'eis'))
+    Pi_Va = Pi @ ss['Va']
+    Wa = beta * Pi_Va
+    c_endog = Wa**(-eis)
+    coh = y[:, np.newaxis] + (1+r)*a_grid
+
+    # where coh lies relative to c_endog + a_grid: index j and weight pi on lower point j
+    j, pi = np.empty_like(coh, dtype=np.int64), np.empty_like(coh)
+    for e in range(len(y)):
+        j[e], pi[e] = sim.interpolate_lottery(coh[e], c_endog[e] + a_grid)
+    coh_endog_gap = np.diff(c_endog + a_grid, axis=1)
+    slope = np.diff(a_grid)[j] / np.take_along_axis(coh_endog_gap, j, axis=1)
+
+    # setmin has zero derivative where constraint binds
+    a = pi*a_grid[j] + (1-pi)*a_grid[j+1]
+    slope[a < a_grid[0]] = 0
+    c = coh - np.maximum(a, a_grid[0])
+
+    # multiply dWa by coh_endog_coef to get dcoh_endog, dc by Va_coef to get dVa
+    Va = (1+r)*c**(-1/eis)
+    return dict(beta_Pi=np.ascontiguousarray(beta*Pi), Pi_Va=Pi_Va, Wa=Wa, c_endog=c_endog,
+                j=j, pi=pi, slope=slope, c=c, Va=Va, a_grid=a_grid, r=r, eis=eis,
+                coh_endog_coef=-eis*c_endog/Wa, Va_coef=-Va/(eis*c),
+                a_grid_gap=np.diff(a_grid)[ss['a_i']])
+
+
+def backward_iteration_linear(dVa, lin, y=0, r=0, beta=0, eis=0):
+    """Derivative of backward_iteration at steady state, mapping derivatives dVa (stacked on
+    a leading axis) and derivatives of inputs y, r, beta, eis into derivatives dVa, da, dc"""
+    # step 1: discounting and expectations
+    dWa = lin['beta_Pi'] @ dVa + beta * lin['Pi_Va']
+    
+    # step 2: derivative of c_endog = Wa**(-eis), then of interpolation at coh
+    dcoh_endog = lin['c_endog'] * (-lin['eis'] * dWa / lin['Wa'] - np.log(lin['Wa']) * eis)
+    dcoh = y + r*lin['a_grid']
+    j, pi = lin['j'][np.newaxis], lin['pi'][np.newaxis]
+    dcoh_endog = pi*np.take_along_axis(dcoh_endog, j, axis=-1) + (1-pi)*np.take_along_axis(dcoh_endog, j+1, axis=-1)
+
+    # step 3: where unconstrained, asset policy moves as coh moves relative to coh_endog
+    da = lin['slope'] * (dcoh - dcoh_endog)
+    dc = dcoh - da
+
+    # step 4: derivative of envelope condition Va = (1+r) * c**(-1/eis)
+    c = lin['c']
+    dVa = lin['Va'] * (r/(1+lin['r']) + (-dc/c + np.log(c)*eis/lin['eis']) / lin['eis'])
+
+    return dVa, da, dc
+
+
+@numba.njit(cache=True)
+def backward_anticipation_linear(dVa, beta_Pi, coh_endog_coef, j, pi, slope, Va_coef, dVa_out, da_out):
+    """Jitted backward_iteration_linear when only Va is perturbed, writing into dVa_out and da_out
+    (dc is just -da), with dVa_out also used as scratch space for dWa and dcoh_endog"""
+    for k in range(dVa.shape[0]):
+        np.dot(beta_Pi, dVa[k], dVa_out[k])
+        dcoh_endog = dVa_out[k]
+        for e in range(dVa.shape[1]):
+            for a in range(dVa.shape[2]):
+                dcoh_endog[e, a] *= coh_endog_coef[e, a]
+            for a in range(dVa.shape[2]):
+                da_out[k, e, a] = -slope[e, a] * (pi[e, a]*dcoh_endog[e, j[e, a]] + (1-pi[e, a])*dcoh_endog[e, j[e, a]+1])
+            for a in range(dVa.shape[2]):
+                dVa_out[k, e, a] = -Va_coef[e, a] * da_out[k, e, a]
+
+
+@numba.njit(cache=True)
+def forward_policy_shock(D, a_i, da_pi):
+    """Derivative of forward_policy for derivatives da_pi (stacked on first axis) of a_pi"""
+    dDend = np.zeros(da_pi.shape)
+    for k in range(da_pi.shape[0]):
+        for e in range(a_i.shape[0]):
+            for a in range(a_i.shape[1]):
+                dDend[k, e, a_i[e,a]] += da_pi[k,e,a]*D[e,a]
+                dDend[k, e, a_i[e,a]+1] -= da_pi[k,e,a]*D[e,a]
+    return dDend
+
+
+@numba.njit(cache=True)
 def J_from_F(F):
     """Recursion J(t,s) = J(t-1,s-1) + F(t,s) to build Jacobian J from fake news F"""
+    # SPEEDUP: jitted scan over rows, each row t adding the already-finished row t-1 shifted by one
     J = F.copy()
     for t in range(1, F.shape[0]):
-        J[1:, t] += J[:-1, t-1]
+        for s in range(1, F.shape[1]):
+            J[t, s] += J[t-1, s-1]
     return J
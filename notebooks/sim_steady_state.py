@@ -5,6 +5,8 @@ Built up in "sim_steady_state_computation.ipynb".
 
 import numpy as np
 import numba
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
 
 
 """Part 0: example calibration from notebook"""
@@ -134,7 +136,7 @@ def get_lottery(a, a_grid):
     return a_i, a_pi
 
 
-@numba.njit
+@numba.njit(cache=True)
 def forward_policy(D, a_i, a_pi):
     Dend = np.zeros_like(D)
     for e in range(a_i.shape[0]):
@@ -183,7 +185,7 @@ def steady_state(Pi, a_grid, y, r, beta, eis):
 
 """Part 5: expectation iterations (see econ411_3_lecture7_supplement_expfunctions.ipynb)"""
 
-@numba.njit
+@numba.njit(cache=True)
 def expectation_policy(Xend, a_i, a_pi):
     X = np.zeros_like(Xend)
     for e in range(a_i.shape[0]):
@@ -209,3 +211,74 @@ def expectation_functions(X, Pi, a_i, a_pi, T):
         curlyE[j] = expectation_iteration(curlyE[j-1], Pi, a_i, a_pi)
         
     return curlyE
+
+
+def expectation_functions_chunked(X, Pi, a_i, a_pi, T, chunk=50, dtype=np.float64):
+    # same curlyEs as expectation_functions, but yielded in consecutive chunks of up to 'chunk'
+    # horizons and stored as 'dtype', so that only one chunk is in memory at a time
+    # (the iteration itself is always done in float64)
+    for start in range(0, T, chunk):
+        curlyE = np.empty((min(chunk, T - start), ) + X.shape, dtype=dtype)
+        for j in range(len(curlyE)):
+            if start + j > 0:
+                X = expectation_iteration(X, Pi, a_i, a_pi)
+            curlyE[j] = X
+        yield curlyE
+
+
+"""Part 6: sparse transition matrix, for repeated iterations and direct solution"""
+
+def transition_matrix(Pi, a_i, a_pi):
+    # step 1: lottery sends mass at flattened (e,a) to (e,i(e,a)) and (e,i(e,a)+1)
+    n_e, n_a = a_i.shape
+    src = np.arange(n_e*n_a)
+    dest = (n_a*np.arange(n_e)[:, np.newaxis] + a_i).ravel()
+    lottery = sparse.csr_matrix((np.concatenate((a_pi.ravel(), 1 - a_pi.ravel())),
+                                 (np.concatenate((dest, dest + 1)), np.concatenate((src, src)))),
+                                shape=(n_e*n_a, n_e*n_a))
+    
+    # step 2: compose with transition from e to e', which is Pi.T (x) identity on flattened grid
+    # (the result has 2*n_e*n_a nonzeros per nonzero in Pi, so best when Pi is sparse)
+    return (sparse.kron(Pi.T, sparse.identity(n_a), format='csr') @ lottery).tocsr()
+
+
+def forward_iteration_sparse(D, Lambda):
+    # same as forward_iteration, with Lambda = transition_matrix(Pi, a_i, a_pi)
+    return (Lambda @ D.ravel()).reshape(D.shape)
+
+
+def expectation_iteration_sparse(X, Lambda):
+    # same as expectation_iteration, since expectations are the transpose of forward iteration
+    return (Lambda.T @ X.ravel()).reshape(X.shape)
+
+
+def expectation_functions_sparse(X, Lambda, T):
+    # transpose once, so that each mat-vec below is row-oriented
+    LambdaT = Lambda.T.tocsr()
+    curlyE = np.empty((T, ) + X.shape)
+    curlyE[0] = X
+    for j in range(1, T):
+        curlyE[j] = (LambdaT @ curlyE[j-1].ravel()).reshape(X.shape)
+    return curlyE
+
+
+def stationary_distribution_sparse(Lambda, shape):
+    # stationary D solves (I - Lambda) D = 0, where columns of I - Lambda sum to zero (Lambda
+    # preserves mass), so its rows are linearly dependent and any one of them is redundant:
+    # replace first row with sum(D) = 1 to get a nonsingular system, then solve by sparse LU
+    N = Lambda.shape[0]
+    A = (sparse.identity(N, format='csr') - Lambda).tolil()
+    A[0, :] = 1
+    b = np.zeros(N)
+    b[0] = 1
+    D = splinalg.spsolve(A.tocsc(), b)
+
+    # clean up roundoff so that total mass is exactly 1 (don't clip negative mass, which
+    # can be legitimate when lotteries extrapolate beyond the top of the grid)
+    return (D / D.sum()).reshape(shape)
+
+
+def distribution_ss_direct(Pi, a, a_grid):
+    # same as distribution_ss, but solving directly rather than iterating
+    a_i, a_pi = get_lottery(a, a_grid)
+    return stationary_distribution_sparse(transition_matrix(Pi, a_i, a_pi), a.shape)
@@ -14,10 +14,14 @@ to define them again. These are marked with # NO CHANGE.
 
 import numpy as np
 import numba
+import itertools
+from collections import OrderedDict, deque
 
 # little need to speed up these functions
-from sim_steady_state import (discretize_assets, rouwenhorst_Pi, forward_iteration,
-                              expectation_iteration, expectation_functions)
+from sim_steady_state import (discretize_assets, rouwenhorst_Pi, forward_policy, forward_iteration,
+                              expectation_iteration, expectation_functions, expectation_functions_chunked,
+                              transition_matrix, forward_iteration_sparse, expectation_iteration_sparse,
+                              expectation_functions_sparse, stationary_distribution_sparse)
 
 """Part 0: example calibration from notebook"""
 
@@ -54,7 +58,7 @@ def discretize_income(rho, sigma, n_e):
 
 """Support for part 1: equality testing and Markov chain convergence"""
 
-@numba.njit
+@numba.njit(cache=True)
 def equal_tolerance(x1, x2, tol):
     # "ravel" flattens both x1 and x2, without making copies, so we can compare the
     # with a single for loop even if they have multiple dimensions
@@ -68,7 +72,7 @@ def equal_tolerance(x1, x2, tol):
     return True
 
 
-@numba.njit
+@numba.njit(cache=True)
 def stationary_markov(Pi, tol=1E-14):
     # start with uniform distribution over all states
     n = Pi.shape[0]
@@ -87,48 +91,103 @@ def stationary_markov(Pi, tol=1E-14):
 """Part 2: Backward iteration for policy"""
 
 def backward_iteration(Va, Pi, a_grid, y, r, beta, eis):
-    # step 1: discounting and expectations
-    Wa = beta * Pi @ Va
-    
-    # step 2: solving for asset policy using the first-order condition
-    c_endog = Wa**(-eis)
-    coh = y[:, np.newaxis] + (1+r)*a_grid
-    # SPEEDUP: interpolation exploits monotonicity and avoids pure-Python for loop
-    a = interpolate_monotonic_loop(coh, c_endog + a_grid, a_grid)
-        
-    # step 3: enforcing the borrowing constraint and backing out consumption
-    # SPEEDUP: enforce constraint in place, without creating new arrays, stop when unnecessary
-    setmin(a, a_grid[0])
-    c = coh - a
-    
-    # step 4: using the envelope condition to recover the derivative of the value function
-    Va = (1+r) * c**(-1/eis)
-    
-    return Va, a, c
+    # SPEEDUP: all four steps are fused into a single jitted kernel, see backward_iteration_fused
+    Va_new, a, c = np.empty_like(Va), np.empty_like(Va), np.empty_like(Va)
+    backward_iteration_fused(Va, beta * Pi, a_grid, y, r, eis, Va_new, a, c)
+    return Va_new, a, c
 
 
-def policy_ss(Pi, a_grid, y, r, beta, eis, tol=1E-9):
+def policy_ss(Pi, a_grid, y, r, beta, eis, tol=1E-9, accelerator=None, Va_init=None):
     # initial guess for Va: assume consumption 5% of cash-on-hand, then get Va from envelope condition
-    coh = y[:, np.newaxis] + (1+r)*a_grid
-    c = 0.05 * coh
-    Va = (1+r) * c**(-1/eis)
+    # (unless warm-starting from some previous solution Va_init)
+    if Va_init is None:
+        coh = y[:, np.newaxis] + (1+r)*a_grid
+        c = 0.05 * coh
+        Va = (1+r) * c**(-1/eis)
+    else:
+        Va = Va_init.copy()
+
+    # SPEEDUP: discount the transition matrix once, and preallocate two sets of buffers
+    # that we alternate between, so that iterations do not allocate any new arrays
+    beta_Pi = beta * Pi
+    Va_old, a_old, c_old = Va, np.empty_like(Va), np.empty_like(Va)
+    Va, a, c = np.empty_like(Va), np.empty_like(Va), np.empty_like(Va)
     
     # iterate until maximum distance between two iterations falls below tol, fail-safe max of 10,000 iterations
     for it in range(10_000):
-        Va, a, c = backward_iteration(Va, Pi, a_grid, y, r, beta, eis)
+        backward_iteration_fused(Va_old, beta_Pi, a_grid, y, r, eis, Va, a, c)
         
         # after iteration 0, can compare new policy function to old one
         # SPEEDUP: only test for convergence every 10 iterations
         # SPEEDUP: use equal_tolerance rather than inefficient NumPy test
-        if it % 10 == 1 and equal_tolerance(a, a_old, tol):
+        # (with an accelerator, tolerance may depend on its estimate of the convergence rate)
+        if it % 10 == 1 and equal_tolerance(a, a_old, tol if accelerator is None else accelerator.tolerance(tol, a)):
             return Va, a, c
+
+        # optionally, replace Va with accelerated guess (see Aitken below)
+        if accelerator is not None:
+            accelerator(Va_old, Va, positive=True)
         
-        a_old = a
+        # swap buffers: this iteration's outputs are next iteration's inputs
+        Va_old, Va = Va, Va_old
+        a_old, a = a, a_old
+        c_old, c = c, c_old
+    raise ValueError(f"Policy failed to converge after {it} iterations")
+
+
+@numba.njit(cache=True)
+def backward_iteration_fused(Va, beta_Pi, a_grid, y, r, eis, Va_out, a_out, c_out):
+    """Backward iteration writing into preallocated Va_out, a_out, c_out, which cannot
+    overlap with Va. Takes discounted transition matrix beta_Pi = beta * Pi."""
+    n_e, n_a = Va.shape
+
+    # step 1: discounting and expectations, using Va_out as scratch space for Wa
+    Wa = Va_out
+    np.dot(beta_Pi, Va, Wa)
+
+    for e in range(n_e):
+        # step 2: solving for asset policy using the first-order condition, using row e
+        # of c_out as scratch space for the endogenous grid of cash-on-hand
+        coh_endog = c_out[e]
+        for a in range(n_a):
+            coh_endog[a] = neg_power(Wa[e, a], eis) + a_grid[a]
+
+        # interpolate exactly as in interpolate_monotonic, computing coh on the fly
+        xp_i = 0
+        xp_lo = coh_endog[0]
+        xp_hi = coh_endog[1]
+        for a in range(n_a):
+            coh = y[e] + (1+r)*a_grid[a]
+            while xp_i < n_a - 2:
+                if coh < xp_hi:
+                    break
+                xp_i += 1
+                xp_lo = xp_hi
+                xp_hi = coh_endog[xp_i + 1]
+            pi = (xp_hi - coh) / (xp_hi - xp_lo)
+            a_out[e, a] = pi * a_grid[xp_i] + (1 - pi) * a_grid[xp_i + 1]
+
+        # step 3: enforcing the borrowing constraint and backing out consumption
+        # step 4: using the envelope condition to recover the derivative of the value function
+        # (row e of Wa and coh_endog no longer needed, so can overwrite Va_out[e] and c_out[e])
+        for a in range(n_a):
+            if a_out[e, a] < a_grid[0]:
+                a_out[e, a] = a_grid[0]
+            c_out[e, a] = y[e] + (1+r)*a_grid[a] - a_out[e, a]
+            Va_out[e, a] = (1+r) * neg_power(c_out[e, a], 1/eis)
+
+
+@numba.njit(cache=True)
+def neg_power(x, k):
+    """Return x**(-k), with fast path for the common case k=1 (log utility)"""
+    if k == 1:
+        return 1 / x
+    return x**(-k)
 
 
 """Support for part 2: equality testing and Markov chain convergence"""
 
-@numba.njit
+@numba.njit(cache=True)
 def interpolate_monotonic(x, xp, yp):
     """Linearly interpolate the data points (xp, yp) and evaluate at x, with both x and xp monotonic"""
     nx, nxp = x.shape[0], xp.shape[0]
@@ -163,7 +222,7 @@ def interpolate_monotonic(x, xp, yp):
     return y
 
 
-@numba.njit
+@numba.njit(cache=True)
 def interpolate_monotonic_loop(x, xp, yp):
     ne = x.shape[0]
     y = np.empty_like(x)
@@ -172,7 +231,7 @@ def interpolate_monotonic_loop(x, xp, yp):
     return y
 
 
-@numba.njit
+@numba.njit(cache=True)
 def setmin(x, xmin):
     """Set 2-dimensional array x, where each row is ascending, equal to max(x, xmin)."""
     ni, nj = x.shape
@@ -188,7 +247,7 @@ def setmin(x, xmin):
 
 """Part 3: forward iteration for distribution"""
 
-@numba.njit
+@numba.njit(cache=True)
 def interpolate_lottery(x, xp):
     """Given a grid of xp, for each entry x_cur in (increasing) x, find the i and pi
     such that x_cur = pi*xp[i] + (1-pi)*xp[i+1], where xp[i] and xp[i+1] bracket x_cur"""
@@ -223,7 +282,7 @@ def interpolate_lottery(x, xp):
     return i, pi
 
 
-@numba.njit
+@numba.njit(cache=True)
 def interpolate_lottery_loop(x, xp):
     i = np.empty_like(x, dtype=np.int64)
     pi = np.empty_like(x)
@@ -232,32 +291,259 @@ def interpolate_lottery_loop(x, xp):
     return i, pi
 
 
-def distribution_ss(Pi, a, a_grid, tol=1E-10):
+def distribution_ss(Pi, a, a_grid, tol=1E-10, accelerator=None, D_init=None):
     a_i, a_pi = interpolate_lottery_loop(a, a_grid)
     
-    # as initial D, use stationary distribution for s, plus uniform over a
-    pi = stationary_markov(Pi)
-    D = pi[:, np.newaxis] * np.ones_like(a_grid) / len(a_grid)
+    # as initial D, use stationary distribution for s, plus uniform over a (unless warm-starting)
+    if D_init is None:
+        pi = stationary_markov(Pi)
+        D = pi[:, np.newaxis] * np.ones_like(a_grid) / len(a_grid)
+    else:
+        D = D_init
     
     # now iterate until convergence to acceptable threshold
     for it in range(10_000):
         D_new = forward_iteration(D, Pi, a_i, a_pi)
         # SPEEDUP: only test for convergence every 10 iterations
         # SPEEDUP: use equal_tolerance rather than inefficient NumPy test
-        if it % 10 == 0 and equal_tolerance(D_new, D, tol):
+        if it % 10 == 0 and equal_tolerance(D_new, D, tol if accelerator is None else accelerator.tolerance(tol, D_new)):
             return D_new
+        if accelerator is not None:
+            accelerator(D, D_new)
         D = D_new
+    raise ValueError(f"Distribution failed to converge after {it} iterations")
+
+
+# ALMOST NO CHANGE (calling interpolate_lottery_loop instead of get_lottery)
+def distribution_ss_direct(Pi, a, a_grid):
+    a_i, a_pi = interpolate_lottery_loop(a, a_grid)
+    return stationary_distribution_sparse(transition_matrix(Pi, a_i, a_pi), a.shape)
+
+
+"""Support for parts 2 and 3: accelerating fixed-point iterations"""
+
+# Accelerators are called as accelerator(x, gx) after each iteration x -> g(x) that has
+# not yet converged, and overwrite gx in place with the next guess. If 'positive', any
+# guess that is not strictly positive is rejected in favor of the plain iteration gx.
+# accelerator.tolerance(tol, x) gives the tolerance actually used to test convergence of x.
+
+class Aitken:
+    """Every K iterations, assume that the error is dominated by a single geometric mode,
+    estimate its rate lam from the shrinkage of the step dx over the last K iterations, and
+    extrapolate to gx + lam/(1-lam)*dx. Works well when convergence is slow because lam is
+    close to 1, e.g. beta near 1. Only extrapolates if the estimate of lam agrees with the one
+    from the K iterations before to within lam_tol*(1-lam), so that we really are in the
+    geometric regime and lam/(1-lam) is accurate, otherwise falls back to a plain step.
+    Once it has extrapolated, tightens the convergence test by a factor 1-lam (see tolerance)."""
+
+    def __init__(self, K=20, lam_max=0.9999, lam_tol=0.1, min_factor=1E-5, max_tight_checks=400):
+        self.K, self.lam_max, self.lam_tol = K, lam_max, lam_tol
+        self.min_factor, self.max_tight_checks = min_factor, max_tight_checks
+        self.dx, self.norms = None, deque(maxlen=2*K+1)
+        self.its, self.extrapolations, self.fallbacks = 0, 0, 0
+        self.lam, self.tight_checks = None, 0
+
+    def __call__(self, x, gx, positive=False):
+        if self.dx is None:
+            self.dx = np.empty_like(x)
+        self.its += 1
+        np.subtract(gx, x, out=self.dx)
+        self.norms.append(np.sqrt(np.vdot(self.dx, self.dx)))
+
+        if self.its % self.K == 0 and len(self.norms) == 2*self.K + 1:
+            n_old, n_mid, n_new = self.norms[0], self.norms[self.K], self.norms[-1]
+            if min(n_old, n_mid, n_new) > 0:
+                lam, lam_prev = (n_new / n_mid)**(1/self.K), (n_mid / n_old)**(1/self.K)
+                if lam < self.lam_max and abs(lam - lam_prev) < self.lam_tol * (1 - lam):
+                    gx_new = gx + lam/(1-lam) * self.dx
+                    if not positive or np.all(gx_new > 0):
+                        gx[...] = gx_new
+                        self.lam = lam
+                        self.extrapolations += 1
+                        return
+            self.fallbacks += 1
+
+    def tolerance(self, tol, x):
+        # stopping when steps fall below tol leaves an error of about tol/(1-lam) in the slow mode,
+        # and an extrapolation skips the iterations that would have shrunk it, so once lam is known
+        # stop at tol*(1-lam) instead: the result is then at least as accurate as without Aitken
+        if self.lam is None:
+            return tol
+        # but not below min_factor*tol, or a few ulps of x that float64 steps cannot resolve,
+        # and if even that is not met after max_tight_checks checks, go back to plain tol
+        self.tight_checks += 1
+        if self.tight_checks > self.max_tight_checks:
+            return tol
+        return min(tol, max(tol * max(1 - self.lam, self.min_factor), 16 * np.spacing(np.abs(x).max())))
+
+    def report(self):
+        return dict(its=self.its, extrapolations=self.extrapolations, fallbacks=self.fallbacks)
 
 
 """Part 4: solving for steady state, including aggregates"""
 
-# ALMOST NO CHANGE (calling interpolate_lottery_loop instead of get_lottery)
-def steady_state(Pi, a_grid, y, r, beta, eis):
-    Va, a, c = policy_ss(Pi, a_grid, y, r, beta, eis)
-    D = distribution_ss(Pi, a, a_grid)
+# calling interpolate_lottery_loop instead of get_lottery, with optional accelerator and warm-start cache
+def steady_state(Pi, a_grid, y, r, beta, eis, accelerator=None, cache=None):
+    # 'accelerator' is optionally a class like Aitken, instantiated for each fixed point
+    accel_policy, accel_dist = (accelerator(), accelerator()) if accelerator is not None else (None, None)
+
+    # 'cache' is optionally a SteadyStateCache, which gives warm start from nearby solution
+    Va_init, D_init = cache.lookup(Pi, a_grid, y, r, beta, eis) if cache is not None else (None, None)
+
+    Va, a, c = policy_ss(Pi, a_grid, y, r, beta, eis, accelerator=accel_policy, Va_init=Va_init)
+    D = distribution_ss(Pi, a, a_grid, accelerator=accel_dist, D_init=D_init)
     a_i, a_pi = interpolate_lottery_loop(a, a_grid)
+    if cache is not None:
+        cache.store(Pi, a_grid, y, r, beta, eis, Va, D)
+    
+    ss = dict(D=D, Va=Va, 
+              a=a, c=c, a_i=a_i, a_pi=a_pi,
+              A=np.vdot(a, D), C=np.vdot(c, D),
+              Pi=Pi, a_grid=a_grid, y=y, r=r, beta=beta, eis=eis)
+    if accelerator is not None:
+        ss['report'] = dict(policy=accel_policy.report(), distribution=accel_dist.report())
+    return ss
+
+
+class SteadyStateCache:
+    """Opt-in cache of converged Va and D from previous calls to steady_state. A later call
+    with the same Pi and a_grid starts from the cached solution whose parameters (y, r, beta,
+    eis) are nearest, which saves many iterations in calibration and estimation loops.
+    Holds up to 'maxsize' solutions, evicting the least recently used, and counts hits and misses.
+
+    By default, only Va is warm-started. Warm-starting D as well saves fewer iterations, and since
+    the slowest mode of the distribution has not fully decayed when distribution_ss stops, it
+    leaves an error in A that is biased toward the cached solution (several times the error
+    from a cold start), which can confuse root-finders. Set warm_distribution=True to do it anyway."""
+
+    def __init__(self, maxsize=16, warm_distribution=False):
+        self.maxsize, self.warm_distribution = maxsize, warm_distribution
+        self.entries, self.ids = OrderedDict(), itertools.count()
+        self.hits, self.misses = 0, 0
     
+    def lookup(self, Pi, a_grid, y, r, beta, eis):
+        key, params = self.key(Pi, a_grid), self.params(y, r, beta, eis)
+        nearest, dist = None, np.inf
+        for i, (key_i, params_i, _, _) in self.entries.items():
+            if key_i == key and len(params_i) == len(params):
+                dist_i = np.linalg.norm(params_i - params)
+                if dist_i < dist:
+                    nearest, dist = i, dist_i
+
+        if nearest is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        self.entries.move_to_end(nearest)
+        _, _, Va, D = self.entries[nearest]
+        return Va, (D if self.warm_distribution else None)
+
+    def store(self, Pi, a_grid, y, r, beta, eis, Va, D):
+        self.entries[next(self.ids)] = (self.key(Pi, a_grid), self.params(y, r, beta, eis),
+                                                 Va.copy(), D.copy())
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def key(Pi, a_grid):
+        return hash((Pi.tobytes(), a_grid.tobytes()))
+
+    @staticmethod
+    def params(y, r, beta, eis):
+        return np.concatenate([np.ravel(x) for x in (y, r, beta, eis)]).astype(np.float64)
+
+
+"""Part 5: batched steady state for many parameter vectors at once"""
+
+def steady_state_batch(Pi, a_grid, y, r, beta, eis, parallel=False, tol_policy=1E-9, tol_dist=1E-10):
+    """Solve K steady states at once, for K different parameter vectors sharing Pi and a_grid.
+    Batched inputs have leading batch axis of length K: r and eis can be scalar or (K,),
+    y can be (n_e,) or (K, n_e), and beta can be scalar, (K,), or (K, n_e) [or (K, n_e, 1)].
+    A single household's heterogeneous beta of shape (n_e, 1), as passed to steady_state,
+    needs an explicit batch axis, e.g. beta[np.newaxis], and is otherwise rejected.
+    If 'parallel', solve the K households on separate threads with numba.prange.
+
+    Returns dict like steady_state, with all arrays stacked along batch axis, plus
+    'converged' flags (if some household fails to converge, its A and C are NaN)."""
+    n_e, n_a = Pi.shape[0], len(a_grid)
+
+    # broadcast all inputs to batch size K
+    y, beta = np.atleast_2d(y), np.asarray(beta, dtype=np.float64)
+    if beta.ndim == 3 and beta.shape[2] == 1:
+        beta = beta[..., 0]
+    if beta.ndim < 2:
+        beta = beta.reshape(-1, 1)
+    elif beta.ndim > 2 or beta.shape[1] != n_e:
+        raise ValueError(f"beta of shape {beta.shape} is not scalar, (K,), (K, {n_e}) or (K, {n_e}, 1), "
+                         f"for a single household's (n_e, 1) beta pass beta[np.newaxis]")
+    r, eis = np.atleast_1d(r), np.atleast_1d(eis)
+    K = max(len(y), len(beta), len(r), len(eis))
+    y, beta = (np.ascontiguousarray(np.broadcast_to(x, (K, n_e)), dtype=np.float64) for x in (y, beta))
+    r, eis = (np.ascontiguousarray(np.broadcast_to(x, K), dtype=np.float64) for x in (r, eis))
+
+    # each household's discounted transition matrix, and stacked outputs
+    beta_Pi = beta[:, :, np.newaxis] * Pi
+    Va, a, c, D, a_pi = (np.empty((K, n_e, n_a)) for _ in range(5))
+    a_i = np.empty((K, n_e, n_a), dtype=np.int64)
+    converged = np.empty(K, dtype=np.bool_)
+
+    solver = steady_state_batch_parallel if parallel else steady_state_batch_serial
+    solver(Pi, beta_Pi, a_grid, y, r, eis, tol_policy, tol_dist, Va, a, c, D, a_i, a_pi, converged)
+
+    A, C = (a * D).sum(axis=(1, 2)), (c * D).sum(axis=(1, 2))
+    A[~converged], C[~converged] = np.nan, np.nan
     return dict(D=D, Va=Va, 
                 a=a, c=c, a_i=a_i, a_pi=a_pi,
-                A=np.vdot(a, D), C=np.vdot(c, D),
-                Pi=Pi, a_grid=a_grid, y=y, r=r, beta=beta, eis=eis)
\ No newline at end of file
+                A=A, C=C, converged=converged,
+                Pi=Pi, a_grid=a_grid, y=y, r=r, beta=beta, eis=eis)
+
+
+@numba.njit(cache=True)
+def steady_state_batch_serial(Pi, beta_Pi, a_grid, y, r, eis, tol_policy, tol_dist, Va, a, c, D, a_i, a_pi, converged):
+    for k in range(len(r)):
+        converged[k] = steady_state_one(Pi, beta_Pi[k], a_grid, y[k], r[k], eis[k], tol_policy, tol_dist,
+                                        Va[k], a[k], c[k], D[k], a_i[k], a_pi[k])
+
+
+@numba.njit(cache=True, parallel=True)
+def steady_state_batch_parallel(Pi, beta_Pi, a_grid, y, r, eis, tol_policy, tol_dist, Va, a, c, D, a_i, a_pi, converged):
+    for k in numba.prange(len(r)):
+        converged[k] = steady_state_one(Pi, beta_Pi[k], a_grid, y[k], r[k], eis[k], tol_policy, tol_dist,
+                                        Va[k], a[k], c[k], D[k], a_i[k], a_pi[k])
+
+
+@numba.njit(cache=True)
+def steady_state_one(Pi, beta_Pi, a_grid, y, r, eis, tol_policy, tol_dist, Va, a, c, D, a_i, a_pi):
+    """Jitted equivalent of steady_state for one household, writing into Va, a, c, D, a_i, a_pi.
+    Returns whether both policy and distribution converged within 10,000 iterations."""
+    n_e, n_a = Va.shape
+
+    # policy: same initial guess and iteration as policy_ss, alternating between two sets of buffers
+    Va_old, a_old, c_old = np.empty_like(Va), np.empty_like(Va), np.empty_like(Va)
+    Va_new, a_new, c_new = np.empty_like(Va), np.empty_like(Va), np.empty_like(Va)
+    for e in range(n_e):
+        for j in range(n_a):
+            Va_old[e, j] = (1+r) * neg_power(0.05 * (y[e] + (1+r)*a_grid[j]), 1/eis)
+    for it in range(10_000):
+        backward_iteration_fused(Va_old, beta_Pi, a_grid, y, r, eis, Va_new, a_new, c_new)
+        if it % 10 == 1 and equal_tolerance(a_new, a_old, tol_policy):
+            break
+        Va_old, Va_new = Va_new, Va_old
+        a_old, a_new = a_new, a_old
+        c_old, c_new = c_new, c_old
+    else:
+        return False
+    Va[:], a[:], c[:] = Va_new, a_new, c_new
+
+    # distribution: same initial guess and iteration as distribution_ss
+    a_i[:], a_pi[:] = interpolate_lottery_loop(a, a_grid)
+    pi = stationary_markov(Pi)
+    for e in range(n_e):
+        D[e, :] = pi[e] / n_a
+    for it in range(10_000):
+        D_new = Pi.T @ forward_policy(D, a_i, a_pi)
+        if it % 10 == 0 and equal_tolerance(D_new, D, tol_dist):
+            D[:] = D_new
+            return True
+        D[:] = D_new
+    return False
@@ -0,0 +1,155 @@
+"""
+Fake news algorithm for the smooth (continuous-income) household in smooth_sim,
+mirroring sim_fake_news for the discrete model.
+
+Computes sequence-space Jacobians of aggregate assets 'A' and consumption 'C'
+for any list of shocked inputs (any combination of shock to 'y', 'r', 'beta',
+'eis', 'sigma', and 'share'). Timing: F[s] is the CDF of beginning-of-period
+assets conditional on current state s, A is end-of-period assets, and C comes
+from the aggregate budget constraint C = (1+r)*A_beginning + Y - A, where
+Y = pi @ y is mean income.
+"""
+
+import numpy as np
+from numba import njit
+from . import smooth_sim as sm, spline, utils
+
+INPUTS = ('Pi', 'a_grid', 'y', 'r', 'beta', 'eis', 'sigma', 'share')
+
+
+def jacobian(ss, shocks, T, h=1E-4):
+    """Gives Jacobian of A and C at horizon 'T' of smooth model around steady
+    state 'ss' (from smooth_sim.steady_state), with respect to each input shock
+    in 'shocks', a dict with entries (i, shock), where 'shock' is itself a dict
+    with entries (k, dx) giving how much 'dx' shock i perturbs each input 'k'."""
+
+    # step 1 for all shocks i, allocate to curlyY[o][i] and curlyD[i]
+    curlyY = {'A': {}, 'C': {}}
+    curlyD = {}
+    for i, shock in shocks.items():
+        curlyYi, curlyD[i] = step1_backward(ss, shock, T, h)
+        curlyY['A'][i], curlyY['C'][i] = curlyYi['A'], curlyYi['C']
+
+    # step 2 for outputs A and C, using steady-state forward operator
+    curlyE = expectation_functions(ss, T-1)
+
+    # steps 3 and 4: build fake news matrices, convert to Jacobians
+    Js = {'A': {}, 'C': {}}
+    for o in Js:
+        for i in shocks:
+            F = np.empty((T, T))
+            F[0, :] = curlyY[o][i]
+            F[1:, :] = curlyE[o].reshape(T-1, -1) @ curlyD[i].reshape(T, -1).T
+            Js[o][i] = J_from_F(F)
+
+    return Js
+
+
+def step1_backward(ss, shock, T, h=1E-4):
+    """Performs step 1 of fake news algorithm, finding curlyY and curlyD up to horizon T
+    given 'shock', by one-sided numerical differentiation, scaling down shock by 'h'."""
+    inputs = {k: ss[k] for k in INPUTS}
+    shocked_inputs = {**inputs, **{k: ss[k] + h*shock[k] for k in shock}}
+    Pi_F = utils.get_Pi_F(ss['Pi'])
+    weights = asset_weights(ss['a_grid'])
+
+    # outputs at date 0 and distribution at date 1 without shock, to difference against
+    Y_noshock, F1_noshock = outputs_and_next(ss['F'], ss['coh_endog'], inputs, Pi_F, weights)
+
+    curlyY = {'A': np.empty(T), 'C': np.empty(T)}
+    curlyF = np.empty((T,) + ss['F'].shape)
+
+    # backward iterate
+    Va = ss['Va']
+    for s in range(T):
+        # at horizon of s=0, 'shock' actually hits, otherwise only effect is through Va
+        inputs_s = shocked_inputs if s == 0 else inputs
+        Va, (_, coh_endog) = sm.backward_iteration(Va, *(inputs_s[k] for k in INPUTS))
+
+        # effects on date-0 outputs and date-1 distribution
+        Y, F1 = outputs_and_next(ss['F'], coh_endog, inputs_s, Pi_F, weights)
+        for o in curlyY:
+            curlyY[o][s] = (Y[o] - Y_noshock[o]) / h
+        curlyF[s] = (F1 - F1_noshock) / h
+
+    return curlyY, curlyF
+
+
+def outputs_and_next(F, coh_endog, inputs, Pi_F, weights):
+    """Given beginning-of-period CDF F, policy coh_endog, and this period's inputs,
+    find outputs A and C this period and the CDF F next period"""
+    Fend = sm.forward_policy(F, coh_endog, inputs['a_grid'], inputs['y'], inputs['r'],
+                             inputs['sigma'], inputs['share'])
+    pi = utils.stationary_markov(inputs['Pi'])
+    A = inputs['a_grid'][0] + pi @ ((1 - Fend) @ weights)
+    A_beginning = inputs['a_grid'][0] + pi @ ((1 - F) @ weights)
+    C = (1 + inputs['r']) * A_beginning + pi @ inputs['y'] - A
+    return {'A': A, 'C': C}, Pi_F @ Fend
+
+
+def asset_weights(a_grid):
+    """Weights v such that a_grid[0] + v @ (1-F) is mean assets given CDF F on a_grid,
+    as in smooth_sim.aggregate_assets_by_state, which is linear in F"""
+    t = spline.make_knots(a_grid)
+    return (t[4:] - t[:-4]) / 4 @ spline.interp_matrix(a_grid)
+
+
+def expectation_functions(ss, T):
+    """curlyE[o][t] such that curlyE[o][t] . dF gives the effect on output o, t periods
+    later, of a perturbation dF to the beginning-of-period CDF, at steady-state policy"""
+    G, w = sm.forward_operator(ss['coh_endog'], ss['a_grid'], ss['y'], ss['r'], ss['sigma'], ss['share'])
+    Pi_F = utils.get_Pi_F(ss['Pi'])
+    weights = asset_weights(ss['a_grid'])
+    pi = utils.stationary_markov(ss['Pi'])
+
+    # A depends on F through end-of-period CDF (1-w)*(G[s] @ F[s]) + w; C through both
+    # A_beginning and A, from the budget constraint
+    curlyE = {'A': np.empty((T,) + ss['F'].shape), 'C': np.empty((T,) + ss['F'].shape)}
+    curlyE['A'][0] = -pi[:, np.newaxis] * expectation_policy(np.tile(weights, (len(pi), 1)), G, w)
+    curlyE['C'][0] = -(1 + ss['r']) * pi[:, np.newaxis] * weights - curlyE['A'][0]
+
+    # recursively apply transpose of forward iteration
+    for o in curlyE:
+        for j in range(1, T):
+            curlyE[o][j] = expectation_policy(Pi_F.T @ curlyE[o][j-1], G, w)
+    return curlyE
+
+
+def expectation_policy(X, G, w):
+    # transpose of dF -> (1-w)*(G[s] @ dF[s]) for each s, the linear part of forward_policy_operator
+    return (((1-w) * X)[:, np.newaxis, :] @ G)[:, 0, :]
+
+
+def transition(ss, shock_paths, T):
+    """Nonlinear perfect-foresight transition of A and C, given dict 'shock_paths' of
+    deviations from steady state of inputs k, with leading axis of length T in time,
+    assuming return to steady state (Va = ss['Va']) after T periods"""
+    inputs = [{**{k: ss[k] for k in INPUTS}, **{k: ss[k] + shock_paths[k][t] for k in shock_paths}}
+              for t in range(T)]
+    Pi_F = utils.get_Pi_F(ss['Pi'])
+    weights = asset_weights(ss['a_grid'])
+
+    # backward iteration for policies
+    coh_endog = np.empty((T,) + ss['F'].shape)
+    Va = ss['Va']
+    for t in reversed(range(T)):
+        Va, (_, coh_endog[t]) = sm.backward_iteration(Va, *(inputs[t][k] for k in INPUTS))
+
+    # forward iteration for distribution and outputs
+    Y = {'A': np.empty(T), 'C': np.empty(T)}
+    F = ss['F']
+    for t in range(T):
+        Yt, F = outputs_and_next(F, coh_endog[t], inputs[t], Pi_F, weights)
+        for o in Y:
+            Y[o][t] = Yt[o]
+    return Y
+
+
+@njit(cache=True)
+def J_from_F(F):
+    """Recursion J(t,s) = J(t-1,s-1) + F(t,s) to build Jacobian J from fake news F"""
+    J = F.copy()
+    for t in range(1, F.shape[0]):
+        for s in range(1, F.shape[1]):
+            J[t, s] += J[t-1, s-1]
+    return J
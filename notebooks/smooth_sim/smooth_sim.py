@@ -1,16 +1,14 @@
 import numpy as np
-from numba import njit
-from scipy import interpolate
+from numba import njit, prange
+from scipy import linalg
+from scipy.sparse import linalg as splinalg
 
 from . import spline, utils
 
-# TODO: can make code more efficient, e.g. by replacing Gauss-Legendre with Gauss-Hermite in unbounded case
-# or by feeding query points more intelligently to spline.val_monotonic
-
 """Backward iteration and steady-state policy and value function"""
 
-@njit
-def backward_iteration(Va, Pi, a_grid, y, r, beta, eis, sigma, share):
+@njit(cache=True)
+def backward_iteration(Va, Pi, a_grid, y, r, beta, eis, sigma, share, parallel=False):
     # Part 1: standard dicounting and expectation step
     Wa = beta * Pi @ Va
 
@@ -18,18 +16,20 @@ def backward_iteration(Va, Pi, a_grid, y, r, beta, eis, sigma, share):
     c_endog = Wa**(-eis)
     coh_endog = c_endog + a_grid
     
-    q = np.empty_like(Va)
-    for s in range(len(y)):
-        q[s] = spline.interp(coh_endog[s], c_endog[s])
-
     # Part 3: integrate over lognormal part of income to get Va(s, a)
     coh_certain, coh_lognormal_mu = coh_components(a_grid, y, r, sigma, share)
 
-    Va = np.empty_like(Va)
-    for s in range(len(y)):
-        for a in range(len(a_grid)):
-            Va[s, a] = expectation_lognormal_coh(coh_certain[s, a], 
-                            coh_endog[s], q[s], coh_lognormal_mu[s], sigma, eis)
+    if parallel:
+        # spline for each s, and expectations for blocks of gridpoints, on separate threads
+        q = spline.interp_rows_parallel(coh_endog, c_endog)
+        Va = expectation_lognormal_coh_parallel(coh_certain, coh_endog, q, coh_lognormal_mu, sigma, eis)
+    else:
+        q = spline.interp_rows(coh_endog, c_endog)
+
+        # SPEEDUP: take expectations for a whole row of gridpoints at once (see expectation_lognormal_coh_row)
+        Va = np.empty_like(Va)
+        for s in range(len(y)):
+            Va[s] = expectation_lognormal_coh_row(coh_certain[s], coh_endog[s], q[s], coh_lognormal_mu[s], sigma, eis)
         
     # Scale by 1+r to reflect returns
     Va *= (1+r)
@@ -37,14 +37,14 @@ def backward_iteration(Va, Pi, a_grid, y, r, beta, eis, sigma, share):
     return Va, (q, coh_endog)
 
 
-@njit
+@njit(cache=True)
 def coh_components(a_grid, y, r, sigma, share):
     coh_certain = (1+r)*a_grid + (1-share)*y[:, np.newaxis] # not including lognormal part
     coh_lognormal_mu = -sigma**2/2 + np.log(share*y)        # mean of log coh above coh_certain
     return coh_certain, coh_lognormal_mu
 
 
-@njit
+@njit(cache=True)
 def expectation_lognormal_coh(coh_certain, coh_grid, q, mu, sigma, eis):
     """Take expectations of marg utility at coh_certain over lognormal part
     of cash-on-hand, given spline q on coh_grid for unconstrained consumption"""
@@ -59,14 +59,65 @@ def expectation_lognormal_coh(coh_certain, coh_grid, q, mu, sigma, eis):
     return constrained_part + unconstrained_part
 
 
-def policy_ss(Pi, a_grid, y, r, beta, eis, sigma, share, tol=1E-9, Va_shock=0):
-    # arbitrary initial guess for consumption, use standard
-    c_init = 0.05 * (y[:, np.newaxis] + a_grid)
-    Va = c_init**(-1/eis)
+@njit(cache=True)
+def expectation_lognormal_coh_row(coh_certain, coh_grid, q, mu, sigma, eis):
+    """Same as expectation_lognormal_coh for each point in increasing coh_certain, but builds the
+    knots for q once, and starts the spline search for each point's quadrature nodes from where
+    it was for the previous point, since the nodes shift up along with coh_certain"""
+    t = spline.make_knots(coh_grid)
+    Va = np.empty_like(coh_certain)
+
+    # SPEEDUP: scratch space for quadrature weights and nodes, reused for every point in row
+    w, x = np.empty(utils.max_nodes()), np.empty(utils.max_nodes())
+    ti = 3
+    for a in range(len(coh_certain)):
+        # constrained part: marginal utility is coh**(-1/eis)
+        n = utils.integrate_lognormal_interval_into(w, x, coh_certain[a], mu, sigma, 0, coh_grid[0])
+        constrained_part = 0.
+        for k in range(n):
+            constrained_part += w[k] * x[k]**(-1/eis)
+
+        # unconstrained part: marginal utility is q(coh)**(-1/eis), with nodes x increasing
+        n = utils.integrate_lognormal_interval_into(w, x, coh_certain[a], mu, sigma, coh_grid[0], np.inf)
+        # (remember where the first node is, to start from there for the next point)
+        unconstrained_part = 0.
+        if n > 0:
+            ti = spline.search_from(t, ti, x[0])
+        ti_k = ti
+        for k in range(n):
+            ti_k = spline.search_from(t, ti_k, x[k])
+            unconstrained_part += w[k] * spline.val_scalar_known_i(q, t, ti_k, x[k])**(-1/eis)
+
+        Va[a] = constrained_part + unconstrained_part
+    return Va
+
+
+
+@njit(cache=True, parallel=True)
+def expectation_lognormal_coh_parallel(coh_certain, coh_endog, q, mu, sigma, eis, block=16):
+    """expectation_lognormal_coh_row for all rows s, split into blocks of gridpoints so that there
+    are many more independent (s, block) tasks than states, each handled by some thread"""
+    n_s, n_a = coh_certain.shape
+    n_blocks = (n_a + block - 1) // block
+    Va = np.empty_like(coh_certain)
+    for task in prange(n_s * n_blocks):
+        s, b = task // n_blocks, task % n_blocks
+        lo, hi = b * block, min((b + 1) * block, n_a)
+        Va[s, lo:hi] = expectation_lognormal_coh_row(coh_certain[s, lo:hi], coh_endog[s], q[s], mu[s], sigma, eis)
+    return Va
+
+
+def policy_ss(Pi, a_grid, y, r, beta, eis, sigma, share, tol=1E-9, Va_shock=0, parallel=False, Va_init=None):
+    # arbitrary initial guess for consumption, use standard (unless warm-starting from Va_init)
+    if Va_init is None:
+        c_init = 0.05 * (y[:, np.newaxis] + a_grid)
+        Va = c_init**(-1/eis)
+    else:
+        Va = Va_init
 
     # iterate until maximum distance between two iterations, as measured by coh_endog, falls below tol
     for it in range(10_000):
-        Va, (q, coh_endog) = backward_iteration(Va + Va_shock, Pi, a_grid, y, r, beta, eis, sigma, share)
+        Va, (q, coh_endog) = backward_iteration(Va + Va_shock, Pi, a_grid, y, r, beta, eis, sigma, share, parallel)
         if it > 0 and np.max(np.abs(coh_endog - coh_endog_old)) < tol:
             break
         coh_endog_old = coh_endog
@@ -81,15 +132,16 @@ def forward_iteration(F, coh_endog, Pi_F, a_grid, y, r, sigma, share):
     return Pi_F @ forward_policy(F, coh_endog, a_grid, y, r, sigma, share)
 
 
-@njit
+@njit(cache=True)
 def forward_policy(F, coh_endog, a_grid, y, r, sigma, share):
     coh_certain, coh_lognormal_mu = coh_components(a_grid, y, r, sigma, share)
 
+    # SPEEDUP: all rows of F are on the same a_grid, so only factor the spline system once
+    qF = spline.interp_shared(a_grid, F)
     Fnew = np.empty_like(F)
     for s in range(len(y)):
-        qF = spline.interp(a_grid, F[s])
         # get CDF on coh_endog, which maps directly to CDF on assets
-        Fnew[s] = iteration_lognormal_coh(qF, coh_certain[s], coh_endog[s], coh_lognormal_mu[s], sigma)
+        Fnew[s] = iteration_lognormal_coh(qF[s], coh_certain[s], coh_endog[s], coh_lognormal_mu[s], sigma)
 
     # ensure that near the top of the distribution, we have exactly 1
     w = utils.smooth_weight(a_grid)
@@ -98,7 +150,7 @@ def forward_policy(F, coh_endog, a_grid, y, r, sigma, share):
     return Fnew
 
 
-@njit
+@njit(cache=True)
 def iteration_lognormal_coh(qF, coh_certain, coh_endog, mu, sigma):
     """Iterate forward distribution from CDF spline qF on coh_certain,
     integrating over lognormal part of cash-on-hand to get CDF on coh_endog"""
@@ -112,45 +164,245 @@ def iteration_lognormal_coh(qF, coh_certain, coh_endog, mu, sigma):
     return Fnew
 
 
-def distribution_ss(coh_endog, Pi, a_grid, y, r, sigma, share, tol=1E-11, maxit=10_000):
-    F = np.ones_like(coh_endog)     # initialize to everyone at constraint
+"""Forward iteration as precomputed linear operator, for repeated iteration given the same policy"""
+
+def forward_operator(coh_endog, a_grid, y, r, sigma, share):
+    """Given policy, forward_policy(F) is (1-w)*(G[s] @ F[s]) + w for each state s, where G[s]
+    combines interpolating the spline on a_grid (same system for any F) with quadrature over
+    the lognormal part of cash-on-hand (same nodes and weights for any F). Return G and w."""
+    coh_certain, coh_lognormal_mu = coh_components(a_grid, y, r, sigma, share)
+    W = quadrature_operator(coh_certain, coh_endog, coh_lognormal_mu, sigma)
+    G = W @ spline.interp_matrix(a_grid)
+    return G, utils.smooth_weight(a_grid)
+
+
+def forward_policy_operator(F, G, w):
+    # equivalent to forward_policy, but given precomputed forward_operator
+    return (1-w)*(G @ F[..., np.newaxis])[..., 0] + w
+
+
+def forward_iteration_operator(F, G, w, Pi_F):
+    return Pi_F @ forward_policy_operator(F, G, w)
+
+
+@njit(cache=True)
+def quadrature_operator(coh_certain, coh_endog, coh_lognormal_mu, sigma):
+    """Matrices W[s] mapping spline coefficients qF on coh_certain[s] to the result of
+    iteration_lognormal_coh, by summing weighted B-spline values at all its quadrature nodes"""
+    n_s, n_a = coh_endog.shape
+    W = np.zeros((n_s, n_a, n_a))
+    w, x = np.empty(utils.max_nodes()), np.empty(utils.max_nodes())
+    for s in range(n_s):
+        t = spline.make_knots(coh_certain[s])
+        cc0 = coh_certain[s, 0]
+        for i in range(n_a):
+            coh = coh_endog[s, i]
+            if coh >= cc0:
+                n = utils.integrate_lognormal_interval_into(w, x, cc0, coh_lognormal_mu[s], sigma, cc0, coh)
+                ti = 3
+                for k in range(n-1, -1, -1):
+                    # same points as in iteration_lognormal_coh, increasing as k decreases
+                    x_cur = coh + cc0 - x[k]
+                    ti = spline.search_from(t, ti, x_cur)
+                    b = spline.val_bsplines_scalar_known_i(t, ti, x_cur)
+                    for m in range(4):
+                        W[s, i, ti-3+m] += w[k] * b[m]
+    return W
+
+
+"""Steady-state distribution"""
+
+def distribution_ss(coh_endog, Pi, a_grid, y, r, sigma, share, tol=1E-11, maxit=10_000,
+                    method='iterate', return_residual=False, F_init=None):
+    """Find steady-state F by iterating forward until F changes by less than 'tol' (method='iterate'),
+    or by directly solving the linear system F = T(F) with a dense LU (method='direct') or matrix-free
+    GMRES (method='gmres'), requiring residual max|T(F) - F| below 'tol'. Optionally return residual.
+    Iteration and GMRES start from F_init if given."""
+    # initialize to everyone at constraint, unless warm-starting from F_init
+    F = np.ones_like(coh_endog) if F_init is None else F_init
     Pi_F = utils.get_Pi_F(Pi)       # transition matrix for conditional CDFs
+
+    # SPEEDUP: policy is fixed, so precompute forward_policy as a linear operator, making each
+    # iteration a few matrix-vector products
+    G, w = forward_operator(coh_endog, a_grid, y, r, sigma, share)
     
-    # iterate until maximum distance between two iterations falls below tol
-    for it in range(maxit):
-        Fnew = forward_iteration(F, coh_endog, Pi_F, a_grid, y, r, sigma, share)
-        if it > 0 and np.max(np.abs(Fnew - F)) < tol:
-            break
-        F = Fnew
+    if method == 'iterate':
+        # iterate until maximum distance between two iterations falls below tol
+        for it in range(maxit):
+            Fnew = forward_iteration_operator(F, G, w, Pi_F)
+            residual = np.max(np.abs(Fnew - F))
+            if it > 0 and residual < tol:
+                break
+            F = Fnew
+        else:
+            raise ValueError(f"Distribution failed to converge after {it} iterations")
+    else:
+        F = distribution_ss_linear(G, w, Pi_F, tol, maxit, method, F)
+        residual = np.max(np.abs(forward_iteration_operator(F, G, w, Pi_F) - F))
+        if not residual < tol:
+            raise ValueError(f"Distribution from method '{method}' has residual {residual:.2E} above tol")
+    return (F, residual) if return_residual else F
+
+
+def distribution_ss_linear(G, w, Pi_F, tol, maxit, method, F_init):
+    """Solve (I - T)F = b, where forward_iteration_operator(F) = T(F) + b, with b = w since
+    rows of Pi_F sum to 1, by dense LU (method='direct') or matrix-free GMRES (method='gmres')"""
+    n_s, n_a = G.shape[:2]
+    b = np.tile(w, n_s)
+
+    if method == 'direct':
+        # T[(s, i), (s', j)] = Pi_F[s, s'] * (1-w[i]) * G[s', i, j]
+        T = Pi_F[:, np.newaxis, :, np.newaxis] * ((1-w)[:, np.newaxis] * G).transpose(1, 0, 2)
+        F = linalg.solve(np.eye(n_s*n_a) - T.reshape(n_s*n_a, n_s*n_a), b)
+    elif method == 'gmres':
+        def I_minus_T(F):
+            F = F.reshape(n_s, n_a)
+            return (F - Pi_F @ ((1-w) * (G @ F[..., np.newaxis])[..., 0])).ravel()
+        A = splinalg.LinearOperator((n_s*n_a, n_s*n_a), matvec=I_minus_T)
+        F, info = splinalg.gmres(A, b, x0=F_init.ravel(), rtol=0, atol=tol, restart=200, maxiter=maxit)
+        if info != 0:
+            raise ValueError(f"GMRES for distribution failed to converge, info={info}")
     else:
-        raise ValueError(f"Distribution failed to converge after {it} iterations")
-    return F
+        raise ValueError(f"Unknown method '{method}' for distribution_ss")
+    return F.reshape(n_s, n_a)
 
 
+@njit(cache=True)
 def aggregate_assets_by_state(F, a_grid):
-    """What are aggregate assets for each state s, given CDF F on a_grid?"""
-    return np.array([interpolate.CubicSpline(a_grid, 1-F[yi])
-                        .integrate(0, a_grid[-1]) for yi in range(F.shape[0])])
+    """What are aggregate assets for each state s, given CDF F on a_grid? Mean is a_grid[0] (zero
+    in this model) plus integral of 1-F above it, taking the integral of the spline in closed form."""
+    qF = spline.interp_shared(a_grid, 1 - F)
+    As = np.empty(F.shape[0])
+    for s in range(F.shape[0]):
+        As[s] = a_grid[0] + spline.integrate(qF[s], a_grid)
+    return As
 
 
 """High-level convenience functions"""
 
-def steady_state(Pi, a_grid, y, r, beta, eis, sigma, share, backward_tol=1E-9, forward_tol=1E-11, Va_shock=0):
-    Va, (q, coh_endog) = policy_ss(Pi, a_grid, y, r, beta, eis, sigma, share, tol=backward_tol, Va_shock=Va_shock)
+def steady_state(Pi, a_grid, y, r, beta, eis, sigma, share, backward_tol=1E-9, forward_tol=1E-11, Va_shock=0,
+                 forward_method='iterate', parallel=False, Va_init=None, F_init=None):
+    # a borrowing limit of zero is built into the model: constrained households consume all of coh,
+    # and expectations integrate over coh from 0
+    if a_grid[0] != 0:
+        raise ValueError(f"Smooth model requires a_grid[0] = 0 (borrowing limit of zero), got {a_grid[0]}")
+
+    Va, (q, coh_endog) = policy_ss(Pi, a_grid, y, r, beta, eis, sigma, share, tol=backward_tol, Va_shock=Va_shock,
+                                   parallel=parallel, Va_init=Va_init)
     
-    F = distribution_ss(coh_endog, Pi, a_grid, y, r, sigma, share, tol=forward_tol)
+    F, F_residual = distribution_ss(coh_endog, Pi, a_grid, y, r, sigma, share, tol=forward_tol,
+                                    method=forward_method, return_residual=True, F_init=F_init)
 
     pi = utils.stationary_markov(Pi)
     As = aggregate_assets_by_state(F, a_grid)
     Cs = r * As + y
     A, C = pi @ As, pi @ Cs
-    return dict(Va=Va, q_policy=q, coh_endog=coh_endog, pi=pi, F=F, A=A, C=C)
+    return dict(Va=Va, q_policy=q, coh_endog=coh_endog, pi=pi, F=F, F_residual=F_residual, A=A, C=C,
+                Pi=Pi, a_grid=a_grid, y=y, r=r, beta=beta, eis=eis, sigma=sigma, share=share)
 
 
 def get_policies(q, coh_endog):
-    """Return consumption and assets as functions of state s and cash-on-hand coh"""
+    """Return consumption and assets as functions of state s and cash-on-hand coh, which can be
+    scalars or arrays of any (broadcastable) shape, in any order"""
+    def evaluate(s, coh):
+        s, coh = np.broadcast_arrays(np.asarray(s, dtype=np.int64), np.asarray(coh, dtype=np.float64))
+        c, a = policy_values(q, coh_endog, s.ravel(), coh.ravel())
+        return c.reshape(s.shape), a.reshape(s.shape)
     def c(s, coh):
-        return (coh > coh_endog[s, 0])*spline.val_monotonic(q[s], coh_endog[s], coh) + (coh <= coh_endog[s, 0])*coh
+        return evaluate(s, coh)[0]
     def a(s, coh):
-        return (coh > coh_endog[s, 0])*(coh - spline.val_monotonic(q[s], coh_endog[s], coh))
+        return evaluate(s, coh)[1]
+    return c, a
+
+
+@njit(cache=True, parallel=True)
+def policy_values(q, coh_endog, s, coh):
+    """Consumption and assets for a batch of (s[i], coh[i]) queries, which need not be sorted,
+    e.g. for simulating many households. Consumption is all of coh below coh_endog[s, 0],
+    since the model's borrowing limit is a_grid[0] = 0 (see steady_state)."""
+    n_s, n_a = coh_endog.shape
+    t = np.empty((n_s, n_a + 4))
+    for j in range(n_s):
+        t[j] = spline.make_knots(coh_endog[j])
+
+    c = np.empty(len(coh))
+    a = np.empty(len(coh))
+    for i in prange(len(coh)):
+        if coh[i] > coh_endog[s[i], 0]:
+            c[i] = spline.val_scalar(q[s[i]], t[s[i]], coh[i])
+            a[i] = coh[i] - c[i]
+        else:
+            c[i] = coh[i]
+            a[i] = 0.
     return c, a
+
+
+"""Adaptive grid refinement"""
+
+def steady_state_adaptive(Pi, a_grid, y, r, beta, eis, sigma, share, tol=1E-6, max_rounds=12, max_n_a=1000,
+                          min_n_a=10, forward_method='gmres', **kwargs):
+    """Solve steady_state starting from coarse a_grid, then repeatedly insert knots at the midpoints of
+    intervals whose estimated spline interpolation error (see grid_errors) exceeds 'tol', and remove
+    knots where error is far below it, warm-starting each round from the previous solution, until the
+    grid stops changing. Endpoints of a_grid are kept fixed. Other kwargs are passed to steady_state.
+    Returned ss includes the final a_grid and its largest estimated interval error 'grid_error'.
+
+    Defaults to forward_method='gmres', since plain iteration can diverge on coarse early-round grids."""
+    Va_init, F_init = None, None
+    for it in range(max_rounds):
+        ss = steady_state(Pi, a_grid, y, r, beta, eis, sigma, share, forward_method=forward_method,
+                          Va_init=Va_init, F_init=F_init, **kwargs)
+        err = grid_errors(ss['q_policy'], ss['coh_endog'], ss['F'], a_grid, ss['A'])
+        a_grid_new = refine_grid(a_grid, err, tol, min_n_a)
+        if len(a_grid_new) == len(a_grid) and np.all(a_grid_new == a_grid):
+            break
+        if len(a_grid_new) > max_n_a:
+            raise ValueError(f"Adaptive grid needs more than max_n_a={max_n_a} points to reach tol={tol}")
+        Va_init, F_init = regrid(ss['Va'], ss['F'], a_grid, a_grid_new, eis)
+        a_grid = a_grid_new
+    else:
+        raise ValueError(f"Adaptive grid failed to converge after {max_rounds} rounds")
+    ss['grid_error'] = err.max()
+    return ss
+
+
+def grid_errors(q, coh_endog, F, a_grid, A):
+    """Estimated interpolation error on each interval of a_grid, max across states, of the consumption
+    policy spline q on coh_endog (whose intervals correspond one-to-one to those of a_grid) relative
+    to the level of consumption, and of the CDF F. Error in F counts both in absolute terms and as the
+    interval's contribution to the error in A = int (1-F) relative to A, with this contribution's
+    allowance split evenly across intervals, which matters in the thin upper tail."""
+    err = np.zeros(len(a_grid) - 1)
+    scale_F = np.maximum(1, (len(a_grid) - 1) * np.diff(a_grid) / A)
+    for s in range(q.shape[0]):
+        c = coh_endog[s] - a_grid
+        err_c = spline.interval_errors(q[s], coh_endog[s]) / c[:-1]
+        err_F = spline.interval_errors(spline.interp(a_grid, F[s]), a_grid) * scale_F
+        err = np.maximum(err, np.maximum(err_c, err_F))
+    return err
+
+
+def refine_grid(a_grid, err, tol, min_n_a):
+    """Split intervals with error above tol at their midpoints. Drop knots between two intervals
+    with error below tol/64, since merging them doubles h and raises error by up to 2^4=16."""
+    n = len(a_grid)
+    keep = np.ones(n, dtype=bool)
+    if n > min_n_a:
+        coarse = np.maximum(err[:-1], err[1:]) < tol / 64
+        # never drop two adjacent knots in one round
+        for i in np.flatnonzero(coarse) + 1:
+            if keep[i-1] and n - (~keep).sum() > min_n_a:
+                keep[i] = False
+    mids = (a_grid[:-1] + a_grid[1:])[err > tol] / 2
+    return np.sort(np.concatenate((a_grid[keep], mids)))
+
+
+def regrid(Va, F, a_grid, a_grid_new, eis):
+    """Interpolate Va (via consumption, which is closer to linear) and F onto a_grid_new for warm start"""
+    Va_new = np.empty((Va.shape[0], len(a_grid_new)))
+    F_new = np.empty_like(Va_new)
+    for s in range(Va.shape[0]):
+        c = spline.val(spline.interp(a_grid, Va[s]**(-1/eis)), a_grid, a_grid_new)
+        Va_new[s] = c**(-eis)
+        F_new[s] = spline.val(spline.interp(a_grid, F[s]), a_grid, a_grid_new)
+    return Va_new, np.clip(F_new, 0, 1)
@@ -1,11 +1,12 @@
 """Simple Numba-compatible cubic spline interpolation and evaluation"""
+import types
 import numpy as np
-from numba import njit
+from numba import njit, prange
 
 
 """Convenience routines for higher-level use"""
 
-@njit
+@njit(cache=True)
 def val(q, xgrid, xs):
     """Given cubic spline coefficients q and original grid xgrid, evaluate spline at all xs in array.
     Robust option that searches for each x separately, requires no structure."""
@@ -15,7 +16,7 @@ def val(q, xgrid, xs):
         ys[i] = val_scalar(q, t, xs[i])
     return ys
 
-@njit
+@njit(cache=True)
 def val_monotonic(q, xgrid, xs):
     """Similar to val, but assumes that xs are also monotonic, so that search can be monotonic,
     best when xs and xgrid have similar length."""
@@ -35,15 +36,25 @@ def val_monotonic(q, xgrid, xs):
         ys[xi] = val_scalar_known_i(q, t, ti, x_cur)
     return ys
 
-@njit
+@njit(cache=True)
+def search_from(t, ti, x):
+    """Starting from some earlier index ti, find index i such that x lies between knots t[i] and t[i+1]
+    (clipped to valid range as in locate), moving down or up, fast when x is near previous query"""
+    while ti > 3 and t[ti] >= x:
+        ti -= 1
+    while ti < len(t) - 5 and t[ti+1] < x:
+        ti += 1
+    return ti
+
+@njit(cache=True)
 def val_scalar(q, t, x):
     return val_scalar_known_i(q, t, locate(t, x), x)
 
-@njit
+@njit(cache=True)
 def val_scalar_with_der(q, t, x):
     return val_scalar_with_der_known_i(q, t, locate(t, x), x)
 
-@njit
+@njit(cache=True)
 def make_knots(x):
     """Given a sorted array x, return the knots t needed to interpolate it with a cubic spline,
     assuming standard not-a-knot for second and second-to-last xs."""
@@ -54,7 +65,7 @@ def make_knots(x):
     t[-4:] = x[-1]
     return t
 
-@njit
+@njit(cache=True)
 def locate(t, x):
     i = np.searchsorted(t, x) - 1
     i = np.maximum(i, 3)
@@ -63,7 +74,7 @@ def locate(t, x):
 
 """Core spline scalar evaluation for known i routines"""
 
-@njit
+@njit(cache=True)
 def val_scalar_known_i(q, t, i, x):
     """Given n cubic spline coefficients q, knots t, and some x lying between knots t[i]
      and t[i+1], evaluate spline at x."""
@@ -81,7 +92,7 @@ def val_scalar_known_i(q, t, i, x):
     return gamma*n0 + (1-gamma)*n1
 
 
-@njit
+@njit(cache=True)
 def val_scalar_with_der_known_i(q, t, i, x):
     """Same as eval_scalar, but also return derivative of spline at x."""
     alpha0 = (t[i+1]-x)/(t[i+1]-t[i-2])
@@ -105,7 +116,7 @@ def val_scalar_with_der_known_i(q, t, i, x):
     return out, dout
 
 
-@njit
+@njit(cache=True)
 def val_bsplines_scalar_known_i(t, i, x):
     """Given knots t and some x lying between knots t[i] and t[i+1], evaluate the
     cubic B-splines i-3 through i (the only nonnegative ones) at x."""
@@ -130,46 +141,64 @@ def val_bsplines_scalar_known_i(t, i, x):
 
 """Obtaining spline coefficients"""
 
-@njit
+@njit(cache=True)
 def interp(x, y):
     """Return B-spline coefficients of cubic spline interpolating (x, y) pairs."""
+    return interp_factored(interp_factor(x), y)
+
+
+@njit(cache=True)
+def interp_factor(x):
+    """Everything in interp that depends only on grid x and not on data y: B-spline values at the
+    second and second-to-last x, and the factored tridiagonal system for the inner coefficients.
+    Pass to interp_factored to get coefficients for any y on the same grid x."""
     t = make_knots(x)
     n = len(x)
-    q = np.empty(n)
-
-    # first and last coefficients equal first and last datapoints
-    q[0] = y[0]
-    q[-1] = y[-1]
 
     # non-boundary knots start at i=4 and end at i=n, evaluate B-splines i-3 through i-1 for each
     # note that all rows of Xs should sum to 1!
     Xtri = np.empty((n-4, 3))
     for i in range(4, n):
         Xtri[i-4] = val_bsplines_scalar_known_i(t, i, t[i])[:3]
-    
-    ytri = y[2:-2].copy()
 
     # also need to evaluate B-splines 0, 1, 2, 3 for second x, and n-4, n-3, n-2, n-1 for second-to-last
     b0, b1, b2, b3 = val_bsplines_scalar_known_i(t, 3, x[1])
     e0, e1, e2, e3 = val_bsplines_scalar_known_i(t, n-1, x[-2])
 
     # reduce system so these rows aren't there, subtracting them from first and last of tridiagonal
-    # first get residual after taking out first and last B-splines...
-    by = y[1] - b0*y[0]
-    ey = y[-2] - e3*y[-1]
-
-    # now subtract first row to kill first element of first row in Xtri, similarly for last row
+    # (we subtract first row to kill first element of first row in Xtri, similarly for last row)
     bratio = Xtri[0, 0] / b1
     eratio = Xtri[-1, -1] / e2
     Xtri[0, 1] -= bratio*b2
     Xtri[0, 2] -= bratio*b3
-    ytri[0] -= bratio*by
     Xtri[-1, 0] -= eratio*e0
     Xtri[-1, 1] -= eratio*e1
-    ytri[-1] -= eratio*ey
 
-    # now inner tridiagonal system ready to be solved
-    q[2:-2] = tridiagonal_solve(Xtri.T, ytri, overwrite=True)
+    boundary = np.array([b0, b1, b2, b3, e0, e1, e2, e3, bratio, eratio])
+    return boundary, tridiagonal_factor(Xtri.T)
+
+
+@njit(cache=True)
+def interp_factored(factor, y, q=None):
+    """Same as interp(x, y), given factor = interp_factor(x), optionally writing into q"""
+    boundary, tri = factor
+    b0, b1, b2, b3, e0, e1, e2, e3, bratio, eratio = boundary
+    if q is None:
+        q = np.empty(len(y))
+
+    # first and last coefficients equal first and last datapoints
+    q[0] = y[0]
+    q[-1] = y[-1]
+
+    # residual after taking out first and last B-splines, then same row operations as in interp_factor
+    by = y[1] - b0*y[0]
+    ey = y[-2] - e3*y[-1]
+    q[2:-2] = y[2:-2]
+    q[2] -= bratio*by
+    q[-3] -= eratio*ey
+
+    # now inner tridiagonal system ready to be solved, in place
+    tridiagonal_solve_factored(tri, q[2:-2])
 
     # finally, back out second and second-to-last coefficients
     q[1] = (by - b2*q[2] - b3*q[3])/b1
@@ -178,7 +207,45 @@ def interp(x, y):
     return q
 
 
-@njit
+def jit_twins(f):
+    """Compile f both serially and with parallel=True. The on-disk cache is keyed by
+    function name, so the parallel version is compiled from a renamed copy of f"""
+    name = f.__name__.lstrip('_') + '_parallel'
+    f_parallel = types.FunctionType(f.__code__, f.__globals__, name, f.__defaults__, f.__closure__)
+    f_parallel.__qualname__ = name
+    return njit(cache=True)(f), njit(cache=True, parallel=True)(f_parallel)
+
+
+def _interp_shared(x, Y):
+    """Coefficients for each row of Y on the same grid x, factoring the system only once"""
+    factor = interp_factor(x)
+    Q = np.empty_like(Y)
+    for s in prange(Y.shape[0]):
+        interp_factored(factor, Y[s], Q[s])
+    return Q
+
+
+def _interp_rows(X, Y):
+    """Coefficients for each row of Y on its own grid, the corresponding row of X"""
+    Q = np.empty_like(Y)
+    for s in prange(Y.shape[0]):
+        interp_factored(interp_factor(X[s]), Y[s], Q[s])
+    return Q
+
+
+# batched versions of interp, across rows (e.g. income states), optionally with rows on separate threads
+interp_shared, interp_shared_parallel = jit_twins(_interp_shared)
+interp_rows, interp_rows_parallel = jit_twins(_interp_rows)
+
+
+@njit(cache=True)
+def interp_matrix(x):
+    """Return matrix M such that M @ y gives the same B-spline coefficients as interp(x, y),
+    so that the tridiagonal system for grid x only needs to be solved once for all y."""
+    return interp_shared(x, np.eye(len(x))).T
+
+
+@njit(cache=True)
 def tridiagonal_solve(abc, d, overwrite=False):
     """See Wikipedia https://en.wikipedia.org/wiki/Tridiagonal_matrix_algorithm
     in the second description of Thomas algorithm with 'less bookkeeping'.
@@ -201,4 +268,108 @@ def tridiagonal_solve(abc, d, overwrite=False):
     for i in range(n-2, -1, -1):
         x[i] = (d[i] - c[i]*x[i+1])/b[i]
 
-    return x
\ No newline at end of file
+    return x
+
+
+@njit(cache=True)
+def tridiagonal_factor(abc):
+    """Forward sweep of tridiagonal_solve that depends only on the matrix, not the right-hand side:
+    return multipliers w, modified diagonal b, and superdiagonal c, for tridiagonal_solve_factored"""
+    a, b, c = abc
+    n = len(b)
+    wbc = np.empty((3, n))
+    w, b_mod = wbc[0], wbc[1]
+    wbc[2] = c
+    b_mod[0] = b[0]
+    w[0] = 0.
+    for i in range(1, n):
+        w[i] = a[i]/b_mod[i-1]
+        b_mod[i] = b[i] - w[i]*c[i-1]
+    return wbc
+
+
+@njit(cache=True)
+def tridiagonal_solve_factored(wbc, d):
+    """Solve tridiagonal system given wbc = tridiagonal_factor(abc), overwriting d with solution"""
+    w, b, c = wbc
+    n = len(d)
+    for i in range(1, n):
+        d[i] -= w[i]*d[i-1]
+
+    d[-1] = d[-1]/b[-1]
+    for i in range(n-2, -1, -1):
+        d[i] = (d[i] - c[i]*d[i+1])/b[i]
+    return d
+
+
+def _tridiagonal_solve_shared(abc, D):
+    """Solve tridiagonal system abc for each row of right-hand sides D, factoring only once"""
+    wbc = tridiagonal_factor(abc)
+    X = D.copy()
+    for s in prange(D.shape[0]):
+        tridiagonal_solve_factored(wbc, X[s])
+    return X
+
+
+def _tridiagonal_solve_rows(abc, D):
+    """Solve tridiagonal system abc[:, s] for each row s of right-hand sides D"""
+    X = D.copy()
+    for s in prange(D.shape[0]):
+        tridiagonal_solve_factored(tridiagonal_factor(abc[:, s]), X[s])
+    return X
+
+
+# batched versions of tridiagonal_solve, optionally with rows on separate threads
+tridiagonal_solve_shared, tridiagonal_solve_shared_parallel = jit_twins(_tridiagonal_solve_shared)
+tridiagonal_solve_rows, tridiagonal_solve_rows_parallel = jit_twins(_tridiagonal_solve_rows)
+
+"""Integration"""
+
+@njit(cache=True)
+def integrate(q, x):
+    """Integral of cubic spline with coefficients q on grid x over [x[0], x[-1]], in closed form:
+    the B-spline with knots t[j] through t[j+4] integrates to (t[j+4]-t[j])/4."""
+    t = make_knots(x)
+    total = 0.
+    for j in range(len(q)):
+        total += q[j] * (t[j+4] - t[j])
+    return total / 4
+
+
+"""Interpolation error estimates"""
+
+@njit(cache=True)
+def third_derivatives(q, x):
+    """Third derivative of cubic spline with coefficients q on grid x, which is constant
+    on each interval [x[i], x[i+1]], found exactly by finite differences within interval."""
+    t = make_knots(x)
+    n = len(x)
+    d3 = np.empty(n-1)
+    ti = 3
+    for i in range(n-1):
+        h = (x[i+1] - x[i]) / 3
+        ti = search_from(t, ti, x[i] + 1.5*h)
+        f0 = val_scalar_known_i(q, t, ti, x[i])
+        f1 = val_scalar_known_i(q, t, ti, x[i] + h)
+        f2 = val_scalar_known_i(q, t, ti, x[i] + 2*h)
+        f3 = val_scalar_known_i(q, t, ti, x[i+1])
+        d3[i] = (f3 - 3*f2 + 3*f1 - f0) / h**3
+    return d3
+
+
+@njit(cache=True)
+def interval_errors(q, x):
+    """Estimate max interpolation error of cubic spline with coefficients q on each interval
+    [x[i], x[i+1]], using the standard bound 5/384*h^4*|f''''|, with fourth derivative
+    estimated from changes in the (piecewise constant) third derivative between intervals.
+    Not-a-knot makes the third derivative continuous across x[1] and x[-2], so the first two
+    and last two intervals use the nearest change in third derivative that is informative."""
+    n = len(x)
+    d3 = third_derivatives(q, x)
+    mid = (x[1:] + x[:-1]) / 2
+    err = np.empty(n-1)
+    for i in range(n-1):
+        lo, hi = min(max(i-1, 1), n-4), max(min(i+1, n-3), 2)
+        d4 = (d3[hi] - d3[lo]) / (mid[hi] - mid[lo])
+        err[i] = 5/384 * (x[i+1] - x[i])**4 * abs(d4)
+    return err
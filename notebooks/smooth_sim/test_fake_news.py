@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from smooth_sim import smooth_sim as sm, utils, fake_news
+
+
+@pytest.fixture(scope='module')
+def ss():
+    a_grid = utils.discretize_assets(0, 10_000, 200)
+    y, pi, Pi = utils.discretize_income(0.92, 0.8, 11)
+    return sm.steady_state(Pi, a_grid, y, 0.02, 0.95, 1, 0.3, 0.8)
+
+
+def test_jacobian_matches_transition(ss):
+    # Jacobian columns should match two-sided finite-difference nonlinear transitions,
+    # up to the O(h) error of the one-sided differences in step 1
+    T, eps = 20, 1E-4
+    shocks = {'r': {'r': 1.}, 'y': {'y': ss['y']}, 'beta': {'beta': 1.}}
+    Js = fake_news.jacobian(ss, shocks, T)
+
+    for i, shock in shocks.items():
+        for s in (0, 7):
+            paths = {k: np.array([eps * np.asarray(dx) * (t == s) for t in range(T)]) for k, dx in shock.items()}
+            up = fake_news.transition(ss, paths, T)
+            down = fake_news.transition(ss, {k: -p for k, p in paths.items()}, T)
+            for o in ('A', 'C'):
+                irf = (up[o] - down[o]) / (2 * eps)
+                assert np.allclose(Js[o][i][:, s], irf, atol=1E-3 * np.abs(irf).max())
+
+
+def test_budget_constraint(ss):
+    # C = (1+r)*A_{-1} + Y - A must hold for Jacobians to first order
+    T = 20
+    Js = fake_news.jacobian(ss, {'y': {'y': ss['y']}}, T)
+    JA, JC = Js['A']['y'], Js['C']['y']
+    JA_lag = np.vstack([np.zeros(T), JA[:-1]])
+    Y = ss['pi'] @ ss['y']
+    assert np.allclose(JC, (1 + ss['r']) * JA_lag + Y * np.eye(T) - JA, atol=1E-6)
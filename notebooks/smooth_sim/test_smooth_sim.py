@@ -1,7 +1,8 @@
 import numpy as np
+import pytest
+from scipy import interpolate
 
-import smooth_sim as sm
-import utils
+from smooth_sim import smooth_sim as sm, spline, utils
 
 def test_basic_calibration():
     # placeholder test to ensure basic functionality remains same, results don't change
@@ -17,3 +18,43 @@ def test_basic_calibration():
     assert np.isclose(ss['A'], 2.7895312553338143)
     assert np.isclose(ss['C'], r*ss['A'] + pi @ y)
 
+
+
+def test_adaptive_grid():
+    # adaptive grid starting from a coarse grid should match A from a much finer fixed grid
+    y, pi, Pi = utils.discretize_income(0.92, 0.8, 11)
+    ss = sm.steady_state_adaptive(Pi, utils.discretize_assets(0, 10_000, 30), y, 0.02, 0.95, 1, 0.3, 0.8, tol=1E-5)
+
+    assert ss['grid_error'] < 1E-5
+    assert len(ss['a_grid']) < 300
+    assert ss['a_grid'][0] == 0 and np.isclose(ss['a_grid'][-1], 10_000)
+    assert np.isclose(ss['A'], 2.789546017811922, rtol=1E-5)   # from fixed grid with 1600 points
+
+
+def test_aggregation_and_policies():
+    a_grid = utils.discretize_assets(0, 10_000, 200)
+    y, pi, Pi = utils.discretize_income(0.92, 0.8, 11)
+    ss = sm.steady_state(Pi, a_grid, y, 0.02, 0.95, 1, 0.3, 0.8)
+
+    # closed-form spline integral matches scipy's not-a-knot CubicSpline
+    As = [interpolate.CubicSpline(a_grid, 1 - F).integrate(0, a_grid[-1]) for F in ss['F']]
+    assert np.allclose(sm.aggregate_assets_by_state(ss['F'], a_grid), As, rtol=1E-12)
+
+    # batched policy evaluation on unsorted queries matches evaluation state by state on sorted ones
+    rng = np.random.default_rng(0)
+    s, coh = rng.integers(0, len(y), 1000), rng.uniform(0, 20, 1000)
+    c, a = sm.policy_values(ss['q_policy'], ss['coh_endog'], s, coh)
+    for si in range(len(y)):
+        order = np.argsort(coh[s == si])
+        coh_s = coh[s == si][order]
+        c_s = spline.val_monotonic(ss['q_policy'][si], ss['coh_endog'][si], coh_s)
+        c_s = np.where(coh_s > ss['coh_endog'][si, 0], c_s, coh_s)
+        assert np.allclose(c[s == si][order], c_s, rtol=1E-13)
+    assert np.allclose(a, coh - c) and np.all(a >= 0)
+
+
+def test_rejects_nonzero_borrowing_limit():
+    # constrained consumption is all of coh, so the model only works with a_grid[0] = 0
+    y, pi, Pi = utils.discretize_income(0.92, 0.8, 11)
+    with pytest.raises(ValueError):
+        sm.steady_state(Pi, utils.discretize_assets(-0.5, 10_000, 200), y, 0.02, 0.95, 1, 0.3, 0.8)
@@ -0,0 +1,48 @@
+import numpy as np
+from scipy import interpolate
+
+from smooth_sim import spline
+
+
+def test_interp_matches_scipy():
+    x = np.sort(np.random.default_rng(0).uniform(0, 10, 30))
+    y = np.sin(x)
+    xs = np.linspace(0, 10, 101)
+    assert np.allclose(spline.val(spline.interp(x, y), x, xs), interpolate.CubicSpline(x, y)(xs))
+
+
+def test_batched_interp():
+    rng = np.random.default_rng(1)
+    X, Y = np.sort(rng.uniform(0, 10, (5, 30)), axis=1), rng.standard_normal((5, 30))
+    Q_shared = np.array([spline.interp(X[0], y) for y in Y])
+    Q_rows = np.array([spline.interp(x, y) for x, y in zip(X, Y)])
+
+    assert np.array_equal(spline.interp_shared(X[0], Y), Q_shared)
+    assert np.array_equal(spline.interp_shared_parallel(X[0], Y), Q_shared)
+    assert np.array_equal(spline.interp_rows(X, Y), Q_rows)
+    assert np.array_equal(spline.interp_rows_parallel(X, Y), Q_rows)
+    assert np.allclose(spline.interp_matrix(X[0]) @ Y[0], Q_shared[0])
+
+
+def test_batched_tridiagonal_solve():
+    rng = np.random.default_rng(2)
+    abc, D = rng.uniform(0, 1, (3, 4, 20)), rng.standard_normal((4, 20))
+    abc[1] += 2     # diagonally dominant
+    def dense(abc):
+        a, b, c = abc
+        return np.diag(b) + np.diag(a[1:], -1) + np.diag(c[:-1], 1)
+
+    assert np.allclose(spline.tridiagonal_solve_shared(abc[:, 0], D), np.linalg.solve(dense(abc[:, 0]), D.T).T)
+    assert np.allclose(spline.tridiagonal_solve_rows(abc, D),
+                       [np.linalg.solve(dense(abc[:, s]), D[s]) for s in range(4)])
+    assert np.array_equal(spline.tridiagonal_solve_rows_parallel(abc, D), spline.tridiagonal_solve_rows(abc, D))
+
+
+def test_parallel_twins_cached_separately():
+    # the on-disk cache is keyed by function name, so serial and parallel versions need distinct names
+    for f, f_parallel in [(spline.interp_shared, spline.interp_shared_parallel),
+                          (spline.interp_rows, spline.interp_rows_parallel),
+                          (spline.tridiagonal_solve_shared, spline.tridiagonal_solve_shared_parallel),
+                          (spline.tridiagonal_solve_rows, spline.tridiagonal_solve_rows_parallel)]:
+        assert f.py_func.__qualname__ != f_parallel.py_func.__qualname__
+        assert f_parallel.targetoptions.get('parallel') and not f.targetoptions.get('parallel')
@@ -2,7 +2,9 @@ import numpy as np
 import pytest
 from scipy.integrate import quad
 
-from utils import integrate_normal_interval, integrate_lognormal_interval, normal_pdf, smooth_weight
+from smooth_sim.utils import (integrate_normal_interval, integrate_lognormal_interval, normal_pdf, smooth_weight,
+                              leg_start, herm_start, integrate_normal_interval_into, integrate_lognormal_interval_into,
+                              max_nodes)
 
 
 """Test integrate_normal_interval"""
@@ -52,8 +54,11 @@ def _reference_lognormal_integral(f, a, mu, sigma, x_l, x_h):
     z_h =  np.inf if np.isinf(x_h) else np.log(x_h - a)
 
     # --- match integrate_normal_interval’s hard cut-off -------------------
-    z_l_clip = max(z_l, mu - 8.0 * sigma)
-    z_h_clip = min(z_h, mu + 8.0 * sigma)
+    # (only for Gauss-Legendre; on the whole line, Gauss-Hermite integrates everything,
+    #  and a window of 20 sigma is enough to capture it)
+    cut = 20.0 if (np.isinf(z_l) and np.isinf(z_h)) else 8.0
+    z_l_clip = max(z_l, mu - cut * sigma)
+    z_h_clip = min(z_h, mu + cut * sigma)
     if z_h_clip <= z_l_clip:           # window vanishes
         return 0.0
 
@@ -94,6 +99,44 @@ def test_lognormal_integral_accuracy(a, mu, sigma, x_l, x_h, fname, func):
                                err_msg=f"{fname} on interval [{x_l},{x_h}]")
 
 
+"""Test configurable number of nodes"""
+
+@pytest.mark.parametrize("n", [20, 60])
+def test_node_count(n):
+    # Gauss-Hermite is used on the whole line, exact for polynomials like 8th central moment
+    w, x = integrate_normal_interval(0.5, 2.0, -np.inf, np.inf, herm=herm_start(n))
+    assert len(x) == n
+    np.testing.assert_allclose(np.dot(w, (x - 0.5)**8), 105 * 2.0**8, rtol=1e-12)
+
+    # Gauss-Legendre is used on finite and half-infinite intervals
+    for x_l, x_h in [(-1.0, 3.0), (-np.inf, 1.0), (0.0, np.inf)]:
+        w, x = integrate_normal_interval(0.5, 2.0, x_l, x_h, leg=leg_start(n))
+        assert len(x) == n
+        np.testing.assert_allclose(np.dot(w, np.cos(0.3*x)),
+                                   _reference_normal_integral(lambda z: np.cos(0.3*z), 0.5, 2.0, x_l, x_h),
+                                   atol=1e-7)
+
+
+"""Test allocation-free versions"""
+
+@pytest.mark.parametrize("a, mu, sigma, x_l, x_h", intervals + [(2.0, 0.0, 1.0, 0.5, 1.5)])
+def test_into_matches(a, mu, sigma, x_l, x_h):
+    # buffers start out with garbage, and are reused across calls
+    w_buf, x_buf = np.full(max_nodes(), np.nan), np.full(max_nodes(), np.nan)
+
+    n = integrate_lognormal_interval_into(w_buf, x_buf, a, mu, sigma, x_l, x_h)
+    w, x = integrate_lognormal_interval(a, mu, sigma, x_l, x_h)
+    assert n == len(x)
+    np.testing.assert_array_equal(w_buf[:n], w)
+    np.testing.assert_array_equal(x_buf[:n], x)
+
+    n = integrate_normal_interval_into(w_buf, x_buf, mu, sigma, x_l, x_h)
+    w, x = integrate_normal_interval(mu, sigma, x_l, x_h)
+    assert n == len(x)
+    np.testing.assert_array_equal(w_buf[:n], w)
+    np.testing.assert_array_equal(x_buf[:n], x)
+
+
 """Test smooth_weight"""
 
 @pytest.mark.parametrize("M, n", [(10.0, 201), (7.3, 97)])   # two grid shapes
@@ -2,54 +2,114 @@ import numpy as np
 from numba import njit
 
 import math
-from numpy.polynomial import legendre
+from numpy.polynomial import legendre, hermite
 
 
 """1. Specific tools needed for smooth model"""
 
-@njit
-def integrate_lognormal_interval(a, mu, sigma, x_l, x_h):
+@njit(cache=True)
+def integrate_lognormal_interval(a, mu, sigma, x_l, x_h, leg=None, herm=None):
     """Give weights w and points x such that evaluating w @ F(x) numerically 
      integrates F(x)*1(x in [x_l, x_h]) if x=y+a, where log y ~ N(mu, sigma^2)"""
     if x_h <= a:
         return np.empty(0), np.empty(0)
 
     logy_l, logy_h = log_with_inf(x_l - a), log_with_inf(x_h - a)
-    w, logy = integrate_normal_interval(mu, sigma, logy_l, logy_h)
+    w, logy = integrate_normal_interval(mu, sigma, logy_l, logy_h, leg, herm)
     x = a + np.exp(logy)
     return w, x
 
 
-@njit
-def integrate_normal_interval(mu, sigma, x_l, x_h):
+@njit(cache=True)
+def integrate_normal_interval(mu, sigma, x_l, x_h, leg=None, herm=None):
     """Give weights w and points x such that evaluating w @ F(x) numerically 
-     integrates F(x)*1(x in [x_l, x_h]) if x ~ N(mu, sigma^2)"""
+     integrates F(x)*1(x in [x_l, x_h]) if x ~ N(mu, sigma^2)
+
+    On the whole real line, use Gauss-Hermite nodes 'herm' (default Herm), otherwise
+    Gauss-Legendre nodes 'leg' (default Leg) on the part of [x_l, x_h] within 8 sigma of mu"""
+    if x_l == -np.inf and x_h == np.inf:
+        if herm is None:
+            herm = Herm
+        return herm_normal(herm, mu, sigma)
+
+    if leg is None:
+        leg = Leg
     aquad = max(mu - 8*sigma, x_l)
     bquad = min(mu + 8*sigma, x_h)
     if aquad >= bquad:
         return np.empty(0), np.empty(0)
     else:
-        w, x = leg_interval(Leg, aquad, bquad)
+        w, x = leg_interval(leg, aquad, bquad)
         return w * normal_pdf(x, mu, sigma), x
+
+
+@njit(cache=True)
+def integrate_lognormal_interval_into(w, x, a, mu, sigma, x_l, x_h, leg=None, herm=None):
+    """Same as integrate_lognormal_interval, but write weights and points into preallocated
+    w and x (of length at least max_nodes(leg, herm)) and return number of points n,
+    so that w[:n] @ F(x[:n]) gives the integral. Allocates nothing."""
+    if x_h <= a:
+        return 0
+
+    n = integrate_normal_interval_into(w, x, mu, sigma, log_with_inf(x_l - a), log_with_inf(x_h - a), leg, herm)
+    for k in range(n):
+        x[k] = a + np.exp(x[k])
+    return n
+
+
+@njit(cache=True)
+def integrate_normal_interval_into(w, x, mu, sigma, x_l, x_h, leg=None, herm=None):
+    """Same as integrate_normal_interval, but write weights and points into preallocated
+    w and x and return number of points n. Allocates nothing."""
+    if x_l == -np.inf and x_h == np.inf:
+        if herm is None:
+            herm = Herm
+        z, wnorm = herm
+        for k in range(len(z)):
+            x[k] = mu + np.sqrt(2)*sigma*z[k]
+            w[k] = wnorm[k] / np.sqrt(np.pi)
+        return len(z)
+
+    if leg is None:
+        leg = Leg
+    aquad = max(mu - 8*sigma, x_l)
+    bquad = min(mu + 8*sigma, x_h)
+    if aquad >= bquad:
+        return 0
+    z, wnorm = leg
+    for k in range(len(z)):
+        x[k] = _demap(z[k], aquad, bquad)
+        w[k] = (bquad-aquad)/2*wnorm[k] * normal_pdf(x[k], mu, sigma)
+    return len(z)
+
+
+@njit(cache=True)
+def max_nodes(leg=None, herm=None):
+    """Length of w and x buffers needed by the *_into integration functions"""
+    if leg is None:
+        leg = Leg
+    if herm is None:
+        herm = Herm
+    return max(len(leg[0]), len(herm[0]))
     
 
-@njit
+@njit(cache=True)
 def log_with_inf(x):
     return np.log(x) if x > 0 else -np.inf
 
 
-@njit
+@njit(cache=True)
 def normal_pdf(x, mu, sigma):
     return np.exp(-((x-mu)/sigma)**2/2)/np.sqrt(2*np.pi)/sigma
 
 
-@njit
+@njit(cache=True)
 def normal_cdf(x, mu, sigma):
     # can only take scalars
     return 0.5*(1 + math.erf((x-mu)/sigma/np.sqrt(2)))
 
 
-@njit
+@njit(cache=True)
 def smooth_weight(x_grid):
     """Smooth weights that go from 0 to 1 over grid, flat at 0 until reaching x_grid[-1]/2"""
     M = x_grid[-1]
@@ -133,22 +193,37 @@ def discretize_income(rho, sigma, n_e):
     return y, pi, Pi
 
 
-"""3. Tools for Gauss-Legendre quadrature"""
+"""3. Tools for Gauss-Legendre and Gauss-Hermite quadrature"""
 
 def leg_start(n):
     return legendre.leggauss(n)
 
-@njit
+@njit(cache=True)
 def leg_interval(S, a, b):
     z, wnorm = S
     x = _demap(z, a, b)
     w = (b-a)/2*wnorm
     return w, x
     
-@njit
+@njit(cache=True)
 def _demap(z, a, b):
     """Map z in [-1,1] to x in [a,b]"""
     return (b-a)/2*(z+1) + a
 
-# here, precalculate a single baseline set of nodes and weights
-Leg = leg_start(40)
\ No newline at end of file
+def herm_start(n):
+    return hermite.hermgauss(n)
+
+@njit(cache=True)
+def herm_normal(S, mu, sigma):
+    """Weights w and points x such that w @ F(x) integrates F(x) against N(mu, sigma^2) pdf"""
+    z, wnorm = S
+    x = mu + np.sqrt(2)*sigma*z
+    w = wnorm / np.sqrt(np.pi)
+    return w, x
+
+# here, precalculate a single baseline set of nodes and weights for each
+# (to use different numbers of nodes, pass e.g. leg=leg_start(n) to the integrate functions)
+# these become constants in the compiled (and cached) integrate functions, so they must exist
+# at compile time and cannot be created lazily; computing them takes about a millisecond
+Leg = leg_start(40)
+Herm = herm_start(30)
\ No newline at end of file
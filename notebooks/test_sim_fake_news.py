@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import sim_steady_state_fast as sim
+import sim_fake_news
+
+
+@pytest.fixture(scope='module')
+def ss():
+    calib = sim.example_calibration()
+    calib['a_grid'] = sim.discretize_assets(0, 10_000, 200)
+    return sim.steady_state(**calib)
+
+
+def test_boolean_output(ss):
+    # the constrained share is a boolean function of policies, and should work on every step 1 path
+    outputs = {'A': lambda a, c: a, 'L': lambda a, c: a <= ss['a_grid'][0]}
+    shocks = {'r': {'r': 1.}, 'y': {'y': ss['y']}}
+    T = 30
+    paths = [('serial', {}), ('parallel', dict(parallel=True)), ('analytic', dict(analytic=True))]
+    Js = {kind: sim_fake_news.jacobian(ss, shocks, T, outputs=outputs, **kwargs) for kind, kwargs in paths}
+
+    for kind, kwargs in paths:
+        Js_default = sim_fake_news.jacobian(ss, shocks, T, **kwargs)
+        for i in shocks:
+            assert np.all(np.isfinite(Js[kind]['L'][i]))
+            assert np.allclose(Js[kind]['A'][i], Js_default['A'][i], rtol=1E-12, atol=0)
+    for i in shocks:
+        assert np.allclose(Js['parallel']['L'][i], Js['serial']['L'][i], atol=1E-12)
+        assert np.abs(Js['serial']['L'][i]).max() > 0
+
+
+def test_analytic_matches_central_differences(ss):
+    # one-sided differences J(dx) and J(-dx) in step 1 average to a central difference, O(h^2) accurate
+    T = 50
+    shocks = {'y': {'y': ss['y']}, 'r': {'r': 1.}, 'beta': {'beta': 1.}, 'eis': {'eis': 1.}}
+    negative = {i: {k: -np.asarray(dx) for k, dx in shock.items()} for i, shock in shocks.items()}
+    Js = sim_fake_news.jacobian(ss, shocks, T, analytic=True)
+    Js_up = sim_fake_news.jacobian(ss, shocks, T)
+    Js_down = sim_fake_news.jacobian(ss, negative, T)
+    for o in ('A', 'C'):
+        for i in shocks:
+            J_central = (Js_up[o][i] - Js_down[o][i]) / 2
+            assert np.allclose(Js[o][i], J_central, atol=1E-6 * np.abs(J_central).max())
+
+
+@pytest.mark.parametrize('k', ['Pi', 'a_grid'])
+def test_analytic_rejects_unsupported_inputs(ss, k):
+    with pytest.raises(ValueError):
+        sim_fake_news.jacobian(ss, {k: {k: np.ones_like(ss[k])}}, 10, analytic=True)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import sim_steady_state as sim
+
+
+@pytest.fixture(scope='module')
+def ss():
+    calib = sim.example_calibration()
+    calib['a_grid'] = sim.discretize_assets(0, 10_000, 200)
+    return sim.steady_state(**calib)
+
+
+def test_sparse_operators_match_dense(ss):
+    Lambda = sim.transition_matrix(ss['Pi'], ss['a_i'], ss['a_pi'])
+
+    # Lambda preserves mass: each column sums to one
+    assert np.allclose(np.asarray(Lambda.sum(axis=0)).ravel(), 1, atol=1E-14)
+
+    # forward iteration on the distribution, and expectation iteration on a non-trivial function
+    D = ss['D']
+    assert np.allclose(sim.forward_iteration_sparse(D, Lambda),
+                       sim.forward_iteration(D, ss['Pi'], ss['a_i'], ss['a_pi']), rtol=0, atol=1E-14)
+    X = ss['c']
+    assert np.allclose(sim.expectation_iteration_sparse(X, Lambda),
+                       sim.expectation_iteration(X, ss['Pi'], ss['a_i'], ss['a_pi']), rtol=1E-12)
+    assert np.allclose(sim.expectation_functions_sparse(X, Lambda, 20),
+                       sim.expectation_functions(X, ss['Pi'], ss['a_i'], ss['a_pi'], 20), rtol=1E-12)
+
+
+def test_direct_distribution_matches_iteration(ss):
+    D_direct = sim.distribution_ss_direct(ss['Pi'], ss['a'], ss['a_grid'])
+    assert np.isclose(D_direct.sum(), 1, rtol=0, atol=1E-14)
+
+    # mass in each income state is the stationary distribution of Pi
+    assert np.allclose(D_direct.sum(axis=1), sim.stationary_markov(ss['Pi']), atol=1E-12)
+    assert np.allclose(D_direct, ss['D'], rtol=0, atol=1E-8)
+    assert np.isclose(np.vdot(ss['a'], D_direct), ss['A'], rtol=1E-5)
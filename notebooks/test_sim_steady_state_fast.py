@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+import sim_steady_state_fast as sim
+
+
+@pytest.fixture(scope='module')
+def calib():
+    # beta-heterogeneity calibration from lecture 3, with beta of shape (n_e, 1)
+    e, _, Pi_e = sim.discretize_income(0.91**(1/4), 0.92, 11)
+    q = 0.01
+    Pi_b = (1-q)*np.eye(4) + q*np.outer(np.ones(4), np.full(4, 1/4))
+    beta_hi, dbeta = 1.0022888126270926, 0.019261748244610084
+    beta = np.kron([beta_hi-3*dbeta, beta_hi-2*dbeta, beta_hi-dbeta, beta_hi], np.ones(11))[:, np.newaxis]
+    return dict(a_grid=sim.discretize_assets(0, 4000, 400), r=0.02/4, eis=1,
+                Pi=np.kron(Pi_b, Pi_e), y=0.7*np.kron(np.ones(4), e), beta=beta)
+
+
+def test_batch_heterogeneous_beta(calib):
+    ss = sim.steady_state(**calib)
+
+    # a single household's (n_e, 1) beta is ambiguous as a batch, so it must get an explicit batch axis
+    with pytest.raises(ValueError):
+        sim.steady_state_batch(**calib)
+    ss_batch = sim.steady_state_batch(**{**calib, 'beta': calib['beta'][np.newaxis]})
+    assert ss_batch['A'].shape == (1,)
+    assert np.isclose(ss_batch['A'][0], ss['A'], rtol=1E-8)
+    assert np.isclose(ss_batch['C'][0], ss['C'], rtol=1E-8)
+
+    # (K, n_e) batch of two households, the second with higher betas
+    beta2 = np.stack([calib['beta'][:, 0], calib['beta'][:, 0] + 0.001])
+    ss_batch = sim.steady_state_batch(**{**calib, 'beta': beta2})
+    assert np.isclose(ss_batch['A'][0], ss['A'], rtol=1E-8) and ss_batch['A'][1] > ss['A']
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('name', ['y', 'r', 'beta', 'eis'])
+def test_batch_matches_separate_solves(name, parallel):
+    # each member of a batch over one parameter is the steady state of a separate call
+    calib = sim.example_calibration()
+    calib['a_grid'] = sim.discretize_assets(0, 10_000, 200)
+    values = {'y': calib['y']*np.array([0.95, 1, 1.05])[:, np.newaxis],
+              'r': calib['r'] + np.array([-0.005, 0, 0.005]),
+              'beta': calib['beta'] - np.array([0.01, 0.005, 0]),
+              'eis': np.array([0.5, 1, 1.5])}[name]
+    ss_batch = sim.steady_state_batch(**{**calib, name: values}, parallel=parallel)
+    assert ss_batch['converged'].all()
+    for k, value in enumerate(values):
+        ss = sim.steady_state(**{**calib, name: value})
+        for x in ('a', 'c', 'D'):
+            assert np.allclose(ss_batch[x][k], ss[x], rtol=1E-12, atol=1E-14)
+        assert np.isclose(ss_batch['A'][k], ss['A'], rtol=1E-12)
+        assert np.isclose(ss_batch['C'][k], ss['C'], rtol=1E-12)
+
+
+def test_cache_keeps_stores_without_lookup():
+    # consecutive stores with no lookup in between must not overwrite each other
+    cache = sim.SteadyStateCache(maxsize=4)
+    calib = sim.example_calibration()
+    calib['a_grid'] = sim.discretize_assets(0, 10_000, 50)
+    Va, D = np.ones((7, 50)), np.ones((7, 50))
+    for r in (0.01, 0.02, 0.03):
+        cache.store(calib['Pi'], calib['a_grid'], calib['y'], r, calib['beta'], calib['eis'], Va, D)
+    assert len(cache.entries) == 3
+
+
+def test_cache_warm_start():
+    # a nearby solve is a hit and converges to the same steady state as a cold solve,
+    # while a different Pi or a_grid is a miss
+    calib = sim.example_calibration()
+    calib['a_grid'] = sim.discretize_assets(0, 10_000, 200)
+    cache = sim.SteadyStateCache()
+    sim.steady_state(**calib, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    calib2 = {**calib, 'beta': calib['beta'] - 0.002, 'r': calib['r'] + 0.001}
+    ss_warm = sim.steady_state(**calib2, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    ss_cold = sim.steady_state(**calib2)
+    assert np.max(np.abs(ss_warm['a'] - ss_cold['a'])) < 1E-7
+    assert np.isclose(ss_warm['A'], ss_cold['A'], rtol=1E-7)
+
+    sim.steady_state(**{**calib2, 'a_grid': sim.discretize_assets(0, 10_000, 201)}, cache=cache)
+    Pi = 0.5*calib['Pi'] + 0.5*np.eye(len(calib['y']))
+    sim.steady_state(**{**calib2, 'Pi': Pi}, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+@pytest.mark.parametrize('tol', [1E-9, 1E-11])
+def test_aitken_converges_and_agrees(calib, tol):
+    # with and without Aitken, both fixed points converge (also at a tight tolerance) and agree
+    # with each other and with the direct solution for the distribution
+    args = [calib[k] for k in ('Pi', 'a_grid', 'y', 'r', 'beta', 'eis')]
+    results = {}
+    for name, accelerator in (('plain', None), ('aitken', sim.Aitken)):
+        Va, a, c = sim.policy_ss(*args, tol=tol, accelerator=accelerator and accelerator())
+        D = sim.distribution_ss(calib['Pi'], a, calib['a_grid'], accelerator=accelerator and accelerator())
+        D_direct = sim.distribution_ss_direct(calib['Pi'], a, calib['a_grid'])
+        results[name] = a, np.vdot(a, D), np.vdot(a, D_direct)
+
+    assert np.max(np.abs(results['aitken'][0] - results['plain'][0])) < 1E-6
+    A_plain, A_plain_direct = results['plain'][1:]
+    A_aitken, A_aitken_direct = results['aitken'][1:]
+    assert np.isclose(A_plain_direct, A_aitken_direct, rtol=1E-8)       # differ by policy tolerance only
+    assert np.isclose(A_aitken, A_aitken_direct, rtol=1E-9)     # Aitken tightens its test, so is closer
+    assert np.isclose(A_plain, A_plain_direct, rtol=1E-5)
+
+
+def test_unconverged_raises():
+    calib = sim.example_calibration()
+    calib['a_grid'] = sim.discretize_assets(0, 10_000, 50)
+    Va, a, c = sim.policy_ss(**calib)
+    with pytest.raises(ValueError):
+        sim.distribution_ss(calib['Pi'], a, calib['a_grid'], tol=-1)
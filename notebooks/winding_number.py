@@ -1,11 +1,12 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from numba import njit
 
 
 def winding_number(j, N=8192, plot=False, **kwargs):
     e = sample_values(j, N)
     if plot:
+        # only needed for plotting, so not imported by workers that just count windings
+        import matplotlib.pyplot as plt
         plt.plot(e.real, e.imag, color='C0', **kwargs)
         # add arrows at beginning and middle to show direction
         for i in (0, N//2):
@@ -39,7 +40,7 @@ def sample_values(j, N=8192):
     return np.concatenate((e, [e[0]]))[::-1]
 
 
-@njit
+@njit(cache=True)
 def winding_number_of_path(x, y):
     """Compute winding number around origin of (x,y) coordinates that make closed path by
     counting number of counterclockwise crossings of ray from (0,0) -> (infty,0) on x axis"""